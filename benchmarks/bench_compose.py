@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""Measures loading, merging, flag generation, the fit check, `up`, `pull` and `convert` on synthetic compose trees.
+
+Everything runs in dry-run mode against a fake docker CLI that answers from memory, so no Docker is needed.
+For every stack size and operation it reports wall time, peak memory allocated by Python (when tracemalloc is
+available) and the number of docker commands issued.
+
+    python benchmarks/bench_compose.py --services 10 100 1000 5000 --json before.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import docker_compose_swarm_mode as dcsm
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class FakeDocker(dcsm.DockerCli):
+    """Answers docker CLI commands from memory and remembers what was created, so a second `up` sees it."""
+
+    def __init__(self, nodes):
+        dcsm.DockerCli.__init__(self)
+        self.nodes = nodes
+        self.services = OrderedDict()
+        self.created_networks = []
+        self.created_volumes = []
+        self.commands = 0
+
+    def call(self, cmd, ignore_return_code=False, prefix=None):
+        self.commands += 1
+        if cmd == 'docker service ls -q':
+            return '\n'.join(self.services)
+        if cmd.startswith('docker service inspect '):
+            return json.dumps(list(self.services.values()))
+        if cmd == 'docker network ls':
+            return 'NETWORK ID  NAME  DRIVER\n' + ''.join('{0}  {0}  overlay\n'.format(name) for name in self.created_networks)
+        if cmd == 'docker volume ls':
+            return 'DRIVER  VOLUME NAME\n' + ''.join('local  {}\n'.format(name) for name in self.created_volumes)
+        if cmd == 'docker node ls -q':
+            return '\n'.join(self.nodes)
+        if cmd.startswith('docker node inspect '):
+            return json.dumps([{'ID': node, 'Description': {'Hostname': node, 'Resources': {'NanoCPUs': 16 * 10 ** 9, 'MemoryBytes': 64 << 30}},
+                                'Spec': {'Role': 'worker', 'Availability': 'active'}, 'Status': {'State': 'ready'}} for node in self.nodes])
+        return ''
+
+    def create_network(self, name):
+        self.created_networks.append(name)
+        return dcsm.DockerCli.create_network(self, name)
+
+    def create_volume(self, name, driver=None):
+        dcsm.DockerCli.create_volume(self, name, driver)
+        self.created_volumes.append(name)
+
+    def create_service(self, name, flags, image, command):
+        dcsm.DockerCli.create_service(self, name, flags, image, command)
+        labels = dict(value.split('=', 1) for key, value in flags if key == '--label')
+        replicas = int(dict(flags).get('--replicas', 1))
+        self.services[name] = {'Spec': {'Name': name, 'Labels': labels, 'Mode': {'Replicated': {'Replicas': replicas}}}}
+
+
+def generate(directory, services, depth, env, labels, volumes, images):
+    """Writes docker-compose.yml, an override file and an `extends` chain of the given depth."""
+    # dumped with sorted keys, so tier names are zero-padded to keep every link after the one it extends
+    common = {}
+    for tier in range(depth):
+        config = {'environment': ['TIER_{}_{}=value'.format(tier, i) for i in range(env)],
+                  'labels': dict(('tier.{}.{}'.format(tier, i), 'value') for i in range(labels))}
+        if tier:
+            config['extends'] = {'service': 'tier{:03d}'.format(tier - 1)}
+        common['tier{:03d}'.format(tier)] = config
+
+    compose = {'version': '3', 'networks': {'front': {}, 'back': {}},
+               'volumes': dict(('data{}'.format(i), {}) for i in range(volumes)), 'services': {}}
+    override = {'version': '3', 'services': {}}
+    for index in range(services):
+        name = 'service{}'.format(index)
+        config = {
+            'image': 'registry.example.com/image{}:1.0'.format(index % images),
+            'command': ['run', '--id', str(index)],
+            'environment': ['VARIABLE_{}=value {}'.format(i, index) for i in range(env)],
+            'labels': dict(('label.{}'.format(i), str(index)) for i in range(labels)),
+            'volumes': ['data{0}:/data/{0}'.format(i) for i in range(volumes)],
+            'networks': ['front', 'back'],
+            'ports': ['{}:80'.format(10000 + index)],
+            'replicas': 1 + index % 3,
+            'mem_limit': '{}m'.format(128 << index % 4),
+        }
+        if depth:
+            config['extends'] = {'file': 'common.yml', 'service': 'tier{:03d}'.format(depth - 1)}
+        if index % 10:
+            config['depends_on'] = ['service{}'.format(index - index % 10)]
+        compose['services'][name] = config
+        if index % 2 == 0:
+            override['services'][name] = {'labels': {'override': 'yes'}}
+
+    paths = []
+    for file_name, content in [('common.yml', {'version': '3', 'services': common}),
+                               ('docker-compose.yml', compose), ('docker-compose.override.yml', override)]:
+        with open(os.path.join(directory, file_name), 'w') as compose_file:
+            yaml.safe_dump(content, compose_file, default_flow_style=False)
+        paths.append(os.path.join(directory, file_name))
+    return paths[1:]
+
+
+def measure(operation):
+    """Runs operation with its output silenced and returns (seconds, peak bytes or None, result)."""
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    started = time.time()
+    try:
+        result = operation()
+    finally:
+        elapsed = time.time() - started
+        sys.stdout.close()
+        sys.stdout, sys.stderr = stdout, stderr
+        peak = None
+        if tracemalloc:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def run(size, args):
+    directory = tempfile.mkdtemp(prefix='compose-bench-')
+    try:
+        paths = generate(directory, size, args.depth, args.env, args.labels, args.volumes, args.images)
+        base_dir = directory + '/'
+        cache_dir = os.path.join(directory, 'cache')
+        compose = dcsm.ComposeLoader(base_dir).load(paths)
+        dcsm.ComposeLoader(base_dir, cache_dir).load(paths)
+        docker = FakeDocker(['node{}'.format(i) for i in range(args.nodes)])
+
+        def project(**options):
+            return dcsm.DockerCompose(compose, 'bench', base_dir, [], backend=docker, **options)
+
+        def flags():
+            compose_project = project()
+            for service in compose_project.filtered_services:
+                compose_project.service_flags(service)
+
+        # compiled once, so that only the bin-packing is measured
+        fit_project = project()
+        fit_configs = [(service, fit_project.service_config(service)) for service in fit_project.filtered_services]
+        nodes = docker.list_nodes()
+
+        operations = [
+            ('load', lambda: dcsm.ComposeLoader(base_dir).load(paths)),
+            ('load (cached)', lambda: dcsm.ComposeLoader(base_dir, cache_dir).load(paths)),
+            ('flags', flags),
+            ('fit check', lambda: dcsm.fit_services(fit_configs, nodes)),
+            ('up', lambda: project(parallel=args.parallel).up()),
+            ('up (unchanged)', lambda: project(parallel=args.parallel).up()),
+            ('pull', lambda: project(parallel=args.parallel).pull()),
+            ('convert', lambda: project().convert()),
+            ('convert (parallel)', lambda: project(parallel=args.parallel).convert()),
+        ]
+
+        results = []
+        for name, operation in operations:
+            samples = []
+            for _ in range(args.repeat):
+                commands = docker.commands
+                elapsed, peak, _result = measure(operation)
+                samples.append((elapsed, peak, docker.commands - commands))
+            # `up` changes the fake cluster, so only the first sample of it is meaningful
+            elapsed, peak, commands = samples[0] if name.startswith('up') else min(samples)
+            results.append(OrderedDict([('services', size), ('operation', name), ('seconds', elapsed),
+                                        ('peak_bytes', peak), ('commands', commands)]))
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark docker-compose-swarm-mode on synthetic compose files.')
+    parser.add_argument('--services', type=int, nargs='+', default=[10, 100, 1000], help='Stack sizes to measure')
+    parser.add_argument('--depth', type=int, default=5, help='Length of the `extends` chain of every service')
+    parser.add_argument('--env', type=int, default=20, help='Environment variables per service and per chain link')
+    parser.add_argument('--labels', type=int, default=10, help='Labels per service and per chain link')
+    parser.add_argument('--volumes', type=int, default=5, help='Named volumes mounted by every service')
+    parser.add_argument('--images', type=int, default=20, help='Number of distinct images')
+    parser.add_argument('--nodes', type=int, default=3, help='Number of swarm nodes reported by the fake cluster')
+    parser.add_argument('--parallel', type=int, default=8, help='Value of --parallel for up, pull and convert')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per operation, the fastest one is reported')
+    parser.add_argument('--json', metavar='PATH', help='Also write the results to PATH for later comparison')
+    args = parser.parse_args()
+
+    dcsm.debug = True
+    results = []
+    print('{:>8}  {:<20}{:>10}{:>12}{:>10}'.format('services', 'operation', 'seconds', 'peak MiB', 'commands'))
+    for size in args.services:
+        for result in run(size, args):
+            peak = '{:.1f}'.format(result['peak_bytes'] / 1048576.0) if result['peak_bytes'] is not None else '-'
+            print('{services:>8}  {operation:<20}{seconds:>10.3f}{peak:>12}{commands:>10}'.format(peak=peak, **result))
+            sys.stdout.flush()
+            results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
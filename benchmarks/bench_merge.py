@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Compares merging compose files in one pass (merge_configs) with folding them pairwise with the previous `merge`.
+
+A base file and several override files are generated in memory; the overrides repeat some ports and volumes of the
+base and add labels and environment variables, without overriding single values (which the previous merge could not
+do). For every stack size it reports the merge time and the number of list entries the merged services end up with:
+the previous merge is faster, as it concatenates lists where merge_configs merges them by name, but keeps duplicates.
+
+    python benchmarks/bench_merge.py --services 100 1000 5000 --overrides 6
+"""
+
+from __future__ import print_function
+
+import argparse
+import copy
+import os
+import sys
+import time
+from collections import OrderedDict
+from functools import reduce
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import docker_compose_swarm_mode as dcsm
+
+
+def pairwise_merge(a, b, path=None):
+    """The previous merge: merges b into a, concatenating lists."""
+    if path is None:
+        path = []
+    for key in b:
+        if key in a:
+            if isinstance(a[key], dict) and isinstance(b[key], dict):
+                pairwise_merge(a[key], b[key], path + [str(key)])
+            elif isinstance(a[key], list) and isinstance(b[key], list):
+                a[key].extend(b[key])
+            elif a[key] == b[key]:
+                pass
+            else:
+                raise Exception('Conflict at %s' % '.'.join(path + [str(key)]))
+        else:
+            a[key] = b[key]
+    return a
+
+
+def generate(services, overrides, env, labels):
+    base = OrderedDict([('version', '3'), ('services', OrderedDict())])
+    for index in range(services):
+        base['services']['service{}'.format(index)] = OrderedDict([
+            ('image', 'registry.example.com/image{}:1.0'.format(index)),
+            ('environment', ['VARIABLE_{}=value'.format(i) for i in range(env)]),
+            ('labels', OrderedDict(('label.{}'.format(i), str(index)) for i in range(labels))),
+            ('ports', ['{}:80'.format(10000 + index)]),
+            ('volumes', ['data:/data', 'logs:/logs']),
+        ])
+    files = [base]
+    for override in range(overrides):
+        files.append(OrderedDict([('services', OrderedDict(
+            ('service{}'.format(index), OrderedDict([
+                ('environment', ['OVERRIDE_{}_{}=value'.format(override, i) for i in range(env // 4)]),
+                ('labels', OrderedDict(('override.{}.{}'.format(override, i), 'yes') for i in range(labels // 4))),
+                ('ports', ['{}:80'.format(10000 + index)]),
+                ('volumes', ['logs:/logs']),
+            ])) for index in range(services)))]))
+    return files
+
+
+def list_entries(compose):
+    return sum(len(value) for service in compose['services'].values() for value in service.values() if isinstance(value, list))
+
+
+def measure(merge, files, repeat):
+    best = None
+    for _ in range(repeat):
+        # the previous merge modifies the files, every run gets fresh ones
+        configs = copy.deepcopy(files)
+        started = time.time()
+        result = merge(configs)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, list_entries(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark merging several compose files.')
+    parser.add_argument('--services', type=int, nargs='+', default=[100, 1000, 5000], help='Stack sizes to measure')
+    parser.add_argument('--overrides', type=int, default=6, help='Number of override files')
+    parser.add_argument('--env', type=int, default=20, help='Environment variables per service in the base file')
+    parser.add_argument('--labels', type=int, default=10, help='Labels per service in the base file')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per merge, the fastest one is reported')
+    args = parser.parse_args()
+
+    merges = [
+        ('pairwise', lambda configs: reduce(pairwise_merge, configs)),
+        ('one pass', lambda configs: dcsm.merge_configs(configs, rules=dcsm.COMPOSE_MERGE_RULES)),
+    ]
+    print('{:>8}  {:<10}{:>10}{:>14}'.format('services', 'merge', 'seconds', 'list entries'))
+    for size in args.services:
+        files = generate(size, args.overrides, args.env, args.labels)
+        for name, merge in merges:
+            elapsed, entries = measure(merge, files, args.repeat)
+            print('{:>8}  {:<10}{:>10.3f}{:>14}'.format(size, name, elapsed, entries))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
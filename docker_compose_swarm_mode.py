@@ -1,449 +1,1813 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
+
 import argparse
+import base64
+import copy
+import ctypes
+import ctypes.util
+import hashlib
+import heapq
+import json
+import multiprocessing
 import os
+import re
+import select
+import signal
+import socket
+import ssl
+import struct
 import subprocess
 import sys
 import threading
+import time
 from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from itertools import chain
 
 import yaml
 import yodl
 
-debug = False
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
+try:
+    import http.client as httplib
+    from urllib.parse import quote, urlencode, urlparse
+except ImportError:
+    import httplib
+    from urllib import quote, urlencode
+    from urlparse import urlparse
 
-class DockerCompose:
-    def __init__(self, compose, project, compose_base_dir, requested_services):
-        self.project = project
-        self.compose_base_dir = compose_base_dir
-        self.services = self.merge_services(compose.get('services', {}))
-        self.networks = compose.get('networks', {})
-        self.volumes = compose.get('volumes', {})
-        self.filtered_services = filter(lambda service: not requested_services or service in requested_services, self.services)
+debug = False
+profiler = None
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+CONFIG_HASH_LABEL = 'docker-compose-swarm-mode.config-hash'
+PLAN_VERSION = 1
+# below this many services convert renders in-process unless --parallel is given, starting the workers costs more than it saves
+CONVERT_POOL_THRESHOLD = 50
+
+# errors a swarm manager reports while it is busy or electing a leader, worth retrying
+TRANSIENT_ERRORS = re.compile(r'rpc error: code = (Unavailable|DeadlineExceeded|Unknown)|context deadline exceeded|'
+                              r'update out of sequence|connection (refused|reset)|cannot connect|i/o timeout|status 50[234]', re.I)
+
+output_lock = threading.Lock()
+helper_credentials_cache = {}  # (credential helper, registry address) -> credentials, asked once per run
+
+
+class ComposeError(Exception):
+    pass
+
+
+class CommandError(ComposeError):
+    def __init__(self, cmd, returncode, output):
+        super(CommandError, self).__init__('command "{}" failed: {}'.format(cmd, output))
+        self.cmd = cmd
+        self.returncode = returncode
+        self.output = output
+
+
+class TaskCancelled(ComposeError):
+    pass
+
+
+class Profiler:
+    """Collects timed spans of the phases, tasks, and docker commands of a run for --profile and --trace."""
+
+    def __init__(self):
+        self.origin = time.time()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def record(self, name, category, started, finished, details):
+        with self.lock:
+            self.spans.append((name, category, started, finished, threading.current_thread().name, details))
+
+    def print_summary(self, top, file=sys.stderr):
+        commands = [span for span in self.spans if span[1] in ('command', 'request')]
+        print('Profile: {:.3f}s in total, {} docker commands taking {:.3f}s'.format(
+            time.time() - self.origin, len(commands), sum(finished - started for _, _, started, finished, _, _ in commands)), file=file)
+        for name, category, started, finished, thread, details in sorted(self.spans, key=lambda span: span[2] - span[3])[:top]:
+            name = name if len(name) <= 100 else name[:97] + '...'
+            print('  {:>9.3f}s  {:<8} {}{}'.format(finished - started, category, name,
+                                                  ''.join(', {} {}'.format(key, value) for key, value in sorted(details.items()))), file=file)
+
+    def write_trace(self, path):
+        """Writes the spans in the Chrome trace event format (chrome://tracing, Perfetto)."""
+        threads = OrderedDict()
+        events = []
+        for name, category, started, finished, thread, details in self.spans:
+            threads.setdefault(thread, len(threads) + 1)
+            events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': 1, 'tid': threads[thread],
+                           'ts': int((started - self.origin) * 1e6), 'dur': int((finished - started) * 1e6), 'args': details})
+        events.extend({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': thread}} for thread, tid in threads.items())
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+@contextmanager
+def span(name, category='phase'):
+    """Times the enclosed block when profiling; details can be added to the yielded dict."""
+    if profiler is None:
+        yield {}
+        return
+    details = {}
+    started = time.time()
+    try:
+        yield details
+    finally:
+        profiler.record(name, category, started, time.time(), details)
+
+
+class Executor:
+    """Runs named callables on a bounded pool of threads, starting each one only after its dependencies succeeded."""
+
+    def __init__(self, workers=1):
+        self.workers = max(1, workers)
+
+    def run(self, tasks, dependencies=None):
+        """Returns an OrderedDict of task name -> None on success or the exception it failed (or was cancelled) with."""
+        dependencies = dependencies or {}
+        pending = OrderedDict((name, set(d for d in dependencies.get(name, ()) if d in tasks)) for name in tasks)
+        check_acyclic(pending)
+
+        results = {}
+        todo = Queue()
+        done = Queue()
+
+        def worker():
+            while True:
+                name = todo.get()
+                if name is None:
+                    return
+                try:
+                    with span(str(name), 'task'):
+                        tasks[name]()
+                    done.put((name, None))
+                except Exception as e:
+                    done.put((name, e))
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.workers, len(tasks)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
 
-    def project_prefix(self, value):
-        return '{}_{}'.format(self.project, value) if self.project else value
+        running = 0
+        while pending or running:
+            for name in [name for name, waiting_for in pending.items() if not waiting_for]:
+                del pending[name]
+                todo.put(name)
+                running += 1
 
-    def merge_services(self, services):
-        result = OrderedDict()
+            name, error = done.get()
+            running -= 1
+            results[name] = error
 
-        for service in services:
-            service_config = services[service]
-            result[service] = service_config
+            if error is None:
+                for waiting_for in pending.values():
+                    waiting_for.discard(name)
+            else:
+                cancelled = [name]
+                while cancelled:
+                    failed = cancelled.pop()
+                    for dependent in [d for d, waiting_for in pending.items() if failed in waiting_for]:
+                        del pending[dependent]
+                        results[dependent] = TaskCancelled('cancelled because {} failed'.format(failed))
+                        cancelled.append(dependent)
+
+        for _ in threads:
+            todo.put(None)
+        # every task is done by now; a daemon thread still running at exit makes Python 2 print tracebacks
+        for thread in threads:
+            thread.join()
 
-            if 'extends' in service_config:
-                extended_config = service_config['extends']
-                extended_service = extended_config['service']
+        return OrderedDict((name, results[name]) for name in tasks)
+
+
+class ClusterState:
+    """One-shot snapshot of the swarm objects, indexed by name."""
+
+    def __init__(self, services=None, networks=None, volumes=(), nodes=()):
+        self.services = dict(services or {})  # name -> service as returned by the engine
+        self.networks = dict(networks or {})  # name -> id
+        self.volumes = set(volumes)
+        self.nodes = list(nodes)  # ready nodes as returned by the engine
+
+    @classmethod
+    def fetch(cls, backend):
+        with span('cluster state'):
+            return cls(
+                services=backend.list_services(),
+                networks=backend.list_networks(),
+                volumes=backend.list_volumes(),
+                nodes=backend.list_nodes(),
+            )
+
+
+class DockerCli:
+    """Runs everything through the docker CLI; used when the engine socket is not reachable and for --dry-run."""
+
+    # the whole command is a single argument of `sh -c`, which Linux limits to 128 KiB (MAX_ARG_STRLEN)
+    max_command_length = 65536
+
+    def __init__(self, timeout=None):
+        self.network_ids = {}
+        self.timeout = timeout
+
+    def call(self, cmd, ignore_return_code=False, prefix=None):
+        """Runs cmd and returns its output; when prefix is given the output is also echoed line by line as it arrives."""
+        echo('Running: \n' + cmd + '\n')
+        if debug:
+            return None
+        with span(' '.join(word for word in cmd.split() if word != '\\'), 'command') as details:
+            # with a timeout the command gets its own process group, so the docker client is killed along with the shell
+            ps = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+                                  preexec_fn=os.setsid if self.timeout else None)
+            lines = []
+
+            def read():
+                for line in iter(ps.stdout.readline, ''):
+                    lines.append(line)
+                    if prefix is not None:
+                        echo(line.rstrip('\n'), prefix)
+                ps.stdout.close()
+
+            reader = threading.Thread(target=read)
+            reader.daemon = True
+            reader.start()
+            reader.join(self.timeout)
+            if reader.is_alive():
+                os.killpg(ps.pid, signal.SIGKILL)
+                reader.join()
+                ps.wait()
+                details['exit code'] = 'killed'
+                raise CommandError(cmd, -signal.SIGKILL, ''.join(lines) + 'timed out after {}s'.format(self.timeout))
 
-                del result[service]['extends']
+            returncode = ps.wait()
+            stdout = ''.join(lines)
+            details.update({'exit code': returncode, 'output bytes': len(stdout)})
+            if returncode != 0 and not ignore_return_code:
+                raise CommandError(cmd, returncode, stdout)
+            return stdout
 
-                if 'file' in extended_config:
-                    extended_service_data = self.merge_services(
-                        yaml.load(open(self.compose_base_dir + extended_config['file'], 'r'), yodl.OrderedDictYAMLLoader)['services']
-                    )[extended_service]
-                else:
-                    extended_service_data = result[extended_service]
+    def rows(self, cmd, separator=r'\s+'):
+        output = self.call(cmd) or ''
+        # skip the header line of the table output
+        return [re.split(separator, line.strip()) for line in output.splitlines()[1:] if line.strip()]
 
-                merge(result[service], extended_service_data, None, self.mergeEnv)
+    def list_services(self):
+        ids = (self.call('docker service ls -q') or '').split()
+        return dict((service['Spec']['Name'], service) for service in self.inspect('service', ids))
 
+    def find_service(self, name):
+        output = self.call('docker service inspect ' + name, ignore_return_code=True)
+        try:
+            return json.loads(output or '[]')[0]
+        except (ValueError, IndexError):
+            return None  # no such service, the error message follows the empty list
+
+    def events(self, types, on_event, since=None):
+        """Calls on_event with every event of the given types the swarm reports, blocking until the stream ends."""
+        cmd = "docker events --format '{{json .}}'" + ''.join(' --filter type=' + kind for kind in types) + \
+              (' --since {}'.format(since) if since else '')
+        echo('Running: \n' + cmd + '\n')
+        if debug:
+            return
+        ps = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, universal_newlines=True)
+        try:
+            for line in iter(ps.stdout.readline, ''):
+                if line.strip():
+                    on_event(json.loads(line))
+        finally:
+            if ps.poll() is None:
+                ps.kill()
+            ps.stdout.close()
+        if ps.wait() != 0:
+            raise CommandError(cmd, ps.returncode, 'event stream interrupted')
+
+    def list_networks(self):
+        self.network_ids = dict((row[1], row[0]) for row in self.rows('docker network ls'))
+        return self.network_ids
+
+    def list_volumes(self):
+        return [row[1] for row in self.rows('docker volume ls')]
+
+    def list_nodes(self):
+        ids = (self.call('docker node ls -q') or '').split()
+        return [node for node in self.inspect('node', ids) if node['Status']['State'] == 'ready']
+
+    def create_network(self, name):
+        network_id = (self.call('docker network create --driver overlay --opt encrypted {0}'.format(name), prefix=name) or '').strip()
+        self.network_ids[name] = network_id
+        return network_id
+
+    def create_volume(self, name, driver=None):
+        cmd = 'docker volume create --name {0}'.format(name)
+        if driver:
+            cmd = cmd + ' --driver={0}'.format(driver)
+        self.call(cmd, prefix=name)
+
+    def create_service(self, name, flags, image, command):
+        cmd = ['docker service create --with-registry-auth \\\n --name', name, '\\\n']
+        for key, value in flags:
+            cmd.extend([key, shellquote(value), '\\\n'])
+        cmd.append(image)
+        cmd.extend(command)
+        self.call(' '.join(cmd), prefix=name)
+
+    def update_service(self, name, flags, image, command, current):
+        update_flags = service_update_flags(service_spec(name, flags, image, command), current['Spec'],
+                                            partial(network_name, self.network_ids))
+        cmd = ['docker service update --with-registry-auth \\\n']
+        for key, value in update_flags:
+            cmd.extend([key, shellquote(value), '\\\n'])
+        cmd.append(name)
+        self.call(' '.join(cmd), prefix=name)
+
+    def scale_services(self, replicas, workers=1):
+        def scale(batch):
+            self.call('docker service scale ' + ' '.join('{}={}'.format(name, replicas[name]) for name in batch))
+
+        return run_batches(self.batches('docker service scale', replicas, lambda name: '{}={}'.format(name, replicas[name])),
+                           scale, workers)
+
+    def remove_services(self, names, workers=1):
+        def remove(batch):
+            try:
+                self.call('docker service rm ' + ' '.join(batch))
+            except CommandError as e:
+                # rerun alone after its batch failed, the service may have been removed by the batch already
+                if len(batch) > 1 or 'not found' not in e.output:
+                    raise
+
+        return run_batches(self.batches('docker service rm', names, lambda name: name), remove, workers)
+
+    def inspect(self, kind, names):
+        """Returns the inspected objects of a kind (service, node), with as few commands as their command lines allow."""
+        cmd = 'docker {} inspect'.format(kind)
+        return [item for batch in self.batches(cmd, names, lambda name: name) for item in json.loads(self.call(cmd + ' ' + ' '.join(batch)))]
+
+    def batches(self, cmd, names, argument):
+        """Splits names into batches whose command lines stay within max_command_length."""
+        batches = [[]]
+        length = len(cmd)
+        for name in names:
+            if batches[-1] and length + 1 + len(argument(name)) > self.max_command_length:
+                batches.append([])
+                length = len(cmd)
+            batches[-1].append(name)
+            length += 1 + len(argument(name))
+        return [batch for batch in batches if batch]
+
+    def service_status(self, names):
+        """Returns name -> (running tasks, desired tasks, being updated) for the services found among names."""
+        result = {}
+        for row in self.rows('docker service ls'):
+            replicas = [column for column in row if re.match(r'^\d+/\d+$', column)]
+            if row[1] in names and replicas:
+                running, desired = [int(count) for count in replicas[0].split('/')]
+                if 'global' in row:
+                    # no task is scheduled yet for a global service that was just created
+                    desired = max(desired, 1)
+                result[row[1]] = (running, desired, False)
+        # the old tasks still count as running until a rolling update replaces them
+        for service in self.inspect('service', list(result)):
+            if is_updating(service):
+                result[service['Spec']['Name']] = result[service['Spec']['Name']][:2] + (True,)
         return result
 
-    @staticmethod
-    def mergeEnv(a, b, key):
-        if key == 'environment':
-            if isinstance(a[key], dict) and isinstance(b[key], list):
-                a[key] = b[key] + list({'{}={}'.format(k, v) for k, v in a[key].items()})
-            elif isinstance(a[key], list) and isinstance(b[key], dict):
-                a[key][:0] = list({'{}={}'.format(k, v) for k, v in b[key].items()})
-            else:
-                raise ('Unknown type of "{}" value (should be either list or dictionary)'.format(key))
+    def image_digest(self, image):
+        # the CLI cannot ask the registry without pulling, so only pinned images are known upfront
+        return image.split('@', 1)[1] if '@' in image else None
+
+    def node_image_digests(self, node, image):
+        output = self.call("docker -H tcp://{}:2375 image inspect --format '{{{{json .RepoDigests}}}}' {}".format(node, image),
+                           ignore_return_code=True)
+        try:
+            return [digest.split('@', 1)[1] for digest in json.loads(output or '[]') or []]
+        except ValueError:
+            return []  # not present on the node
+
+    def pull_image(self, node, image):
+        self.call('docker -H tcp://{}:2375 pull {}'.format(node, image), prefix=node)
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class EngineError(ComposeError):
+    def __init__(self, method, url, status, message):
+        super(EngineError, self).__init__('request "{} {}" failed with status {}: {}'.format(method, url, status, message))
+        self.status = status
+
+
+def response_lines(response):
+    """Yields the lines of a streamed response as they arrive."""
+    if hasattr(response, 'readline'):
+        for line in iter(response.readline, b''):
+            yield line
+        return
+    # Python 2's HTTPResponse cannot read lines, and read() waits for the whole body: the rest of the current chunk is
+    # read instead, one byte when the next one has not started yet
+    pending = b''
+    while True:
+        data = response.read(response.chunk_left or 1) if response.chunked else response.read()
+        if not data:
+            break
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if pending:
+        yield pending
+
+
+class DockerEngine:
+    """Talks to the Docker Engine API over a pool of keep-alive connections."""
+
+    api_version = 'v1.24'
+    events_api_version = 'v1.30'  # service and node events are reported since
+
+    def __init__(self, base_url='unix:///var/run/docker.sock', tls=None, timeout=60, pool_size=16):
+        url = urlparse(base_url)
+        if url.scheme == 'unix':
+            self.connection_factory = partial(UnixHTTPConnection, url.path, timeout=timeout)
+        elif tls is not None:
+            self.connection_factory = partial(httplib.HTTPSConnection, url.hostname, url.port or 2376, timeout=timeout, context=tls)
+        else:
+            self.connection_factory = partial(httplib.HTTPConnection, url.hostname, url.port or 2375, timeout=timeout)
+        self.base_url = base_url
+        self.tls = tls
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.idle_connections = []
+        self.node_engines = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        tls = None
+        if os.environ.get('DOCKER_TLS_VERIFY'):
+            cert_path = os.environ.get('DOCKER_CERT_PATH', os.path.expanduser('~/.docker'))
+            tls = ssl.create_default_context(cafile=os.path.join(cert_path, 'ca.pem'))
+            tls.check_hostname = False
+            tls.load_cert_chain(os.path.join(cert_path, 'cert.pem'), os.path.join(cert_path, 'key.pem'))
+        return cls(os.environ.get('DOCKER_HOST', 'unix:///var/run/docker.sock'), tls, int(os.environ.get('COMPOSE_HTTP_TIMEOUT', 60)))
 
     @staticmethod
-    def call(cmd, ignore_return_code=False):
-        print('Running: \n' + cmd + '\n')
-        if not debug:
-            ps = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            returncode = ps.wait()
-            stdout = ps.communicate()[0]
-            if returncode != 0 and not ignore_return_code:
-                print >> sys.stderr, ('Error: command "{}" failed: {}'.format(cmd, stdout))
-                sys.exit(returncode)
+    def is_available():
+        url = urlparse(os.environ.get('DOCKER_HOST', 'unix:///var/run/docker.sock'))
+        return url.scheme == 'tcp' or (url.scheme == 'unix' and os.path.exists(url.path))
+
+    def node_engine(self, node):
+        with self.lock:
+            if node not in self.node_engines:
+                self.node_engines[node] = DockerEngine('tcp://{}:2375'.format(node), timeout=self.timeout, pool_size=4)
+            return self.node_engines[node]
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if not self.idle_connections:
+                    break
+                connection = self.idle_connections.pop()
+            # an idle connection that is readable has been closed by the engine meanwhile
+            if connection.sock is not None and not select.select([connection.sock], [], [], 0)[0]:
+                return connection, True
+            connection.close()
+        return self.connection_factory(), False
+
+    def release(self, connection, response):
+        with self.lock:
+            if not response.will_close and len(self.idle_connections) < self.pool_size:
+                self.idle_connections.append(connection)
+                return
+        connection.close()
+
+    def request(self, method, path, query=None, body=None, headers=None, on_line=None):
+        url = '/{}{}'.format(self.api_version, path)
+        if query:
+            url += '?' + urlencode(query)
+
+        if method != 'GET':
+            echo('Running: \n{} {} {}\n'.format(method, self.base_url, url) + (json.dumps(body) + '\n' if body is not None else ''))
+            if debug:
+                return None
+
+        data = json.dumps(body) if body is not None else None
+        headers = dict(headers or {}, **({'Content-Type': 'application/json'} if data is not None else {}))
+
+        with span('{} {}'.format(method, url), 'request') as details:
+            while True:
+                connection, reused = self.acquire()
+                sent = False
+                try:
+                    connection.request(method, url, data, headers)
+                    sent = True
+                    response = connection.getresponse()
+                    if on_line is not None and response.status < 400:
+                        # streamed responses (e.g. pull progress) are handed over as they arrive
+                        lines = []
+                        for line in response_lines(response):
+                            lines.append(line)
+                            on_line(line.decode('utf-8'))
+                        payload = b''.join(lines).decode('utf-8')
+                    else:
+                        payload = response.read().decode('utf-8')
+                    break
+                except (socket.error, httplib.HTTPException) as e:
+                    connection.close()
+                    if not reused:
+                        raise ComposeError('cannot connect to Docker engine at {}: {}'.format(self.base_url, e))
+                    # the engine may still close a reused connection just as the request goes out; a request that was
+                    # sent is only repeated if it changes nothing, and never after a timeout
+                    if isinstance(e, socket.timeout) or (sent and method != 'GET'):
+                        raise ComposeError('request "{} {}" to Docker engine at {} failed: {}'.format(method, url, self.base_url, e))
+
+            self.release(connection, response)
+            details.update({'status': response.status, 'response bytes': len(payload)})
+
+        if response.status >= 400:
+            try:
+                message = json.loads(payload)['message']
+            except (ValueError, KeyError, TypeError):
+                message = payload
+            raise EngineError(method, url, response.status, message)
+
+        if payload and on_line is None and response.getheader('Content-Type', '').startswith('application/json'):
+            return json.loads(payload)
+        return payload
+
+    def list_services(self):
+        return dict((service['Spec']['Name'], service) for service in self.request('GET', '/services'))
+
+    def inspect_service(self, name):
+        return self.request('GET', '/services/' + quote(name))
+
+    def find_service(self, name):
+        try:
+            return self.inspect_service(name)
+        except EngineError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def events(self, types, on_event, since=None):
+        """Calls on_event with every event of the given types the swarm reports, blocking until the stream ends."""
+        query = {'filters': json.dumps({'type': types})}
+        if since:
+            query['since'] = since
+        url = '/{}/events?{}'.format(self.events_api_version, urlencode(query))
+        # a connection of its own without the timeout, the stream is idle for as long as nothing happens
+        connection = self.connection_factory(timeout=None)
+        try:
+            connection.request('GET', url)
+            response = connection.getresponse()
+            if response.status >= 400:
+                raise EngineError('GET', url, response.status, response.read().decode('utf-8'))
+            for line in response_lines(response):
+                if line.strip():
+                    on_event(json.loads(line.decode('utf-8')))
+        except (socket.error, httplib.HTTPException) as e:
+            raise ComposeError('event stream from {} interrupted: {}'.format(self.base_url, e))
+        finally:
+            connection.close()
+
+    def list_networks(self):
+        return dict((network['Name'], network['Id']) for network in self.request('GET', '/networks'))
+
+    def list_volumes(self):
+        return [volume['Name'] for volume in self.request('GET', '/volumes').get('Volumes') or []]
+
+    def list_nodes(self):
+        return [node for node in self.request('GET', '/nodes') if node['Status']['State'] == 'ready']
+
+    def create_network(self, name):
+        response = self.request('POST', '/networks/create',
+                                body={'Name': name, 'Driver': 'overlay', 'Options': {'encrypted': ''}, 'CheckDuplicate': True})
+        return (response or {}).get('Id', '')
+
+    def create_volume(self, name, driver=None):
+        self.request('POST', '/volumes/create', body=dict({'Name': name}, **({'Driver': driver} if driver else {})))
+
+    def create_service(self, name, flags, image, command):
+        auth = registry_auth(image)
+        self.request('POST', '/services/create', body=service_spec(name, flags, image, command),
+                     headers={'X-Registry-Auth': auth} if auth else None)
+
+    def update_service(self, name, flags, image, command, current):
+        auth = registry_auth(image)
+        self.request('POST', '/services/{}/update'.format(current['ID']), query={'version': current['Version']['Index']},
+                     body=service_spec(name, flags, image, command), headers={'X-Registry-Auth': auth} if auth else None)
+
+    def scale_services(self, replicas, workers=1):
+        def scale(batch):
+            name, = batch
+            service = self.inspect_service(name)
+            spec = service['Spec']
+            if 'Replicated' not in spec.get('Mode', {}):
+                raise ComposeError('scale can only be used with replicated mode, service "{}" is not'.format(name))
+            spec['Mode']['Replicated']['Replicas'] = int(replicas[name])
+            self.request('POST', '/services/{}/update'.format(service['ID']), query={'version': service['Version']['Index']}, body=spec)
+
+        return run_batches([[name] for name in replicas], scale, workers)
+
+    def remove_services(self, names, workers=1):
+        def remove(batch):
+            self.request('DELETE', '/services/' + quote(batch[0]))
+
+        return run_batches([[name] for name in names], remove, workers)
+
+    def service_status(self, names):
+        services = dict((service['ID'], service) for service in self.request('GET', '/services') if service['Spec']['Name'] in names)
+        running = dict((service_id, 0) for service_id in services)
+        scheduled = dict((service_id, 0) for service_id in services)
+
+        for task in self.request('GET', '/tasks', query={'filters': json.dumps({'desired-state': ['running']})}):
+            if task.get('ServiceID') in services:
+                scheduled[task['ServiceID']] += 1
+                running[task['ServiceID']] += task['Status']['State'] == 'running'
+
+        result = {}
+        for service_id, service in services.items():
+            mode = service['Spec']['Mode']
+            # no task is scheduled yet for a global service that was just created
+            desired = mode['Replicated']['Replicas'] if 'Replicated' in mode else max(scheduled[service_id], 1)
+            result[service['Spec']['Name']] = (running[service_id], desired, is_updating(service))
+        return result
+
+    def image_digest(self, image):
+        if '@' in image:
+            return image.split('@', 1)[1]
+        auth = registry_auth(image)
+        try:
+            descriptor = self.request('GET', '/distribution/{}/json'.format(image), headers={'X-Registry-Auth': auth} if auth else None)
+        except EngineError:
+            return None  # the engine is too old or the registry doesn't tell; the image will just be pulled
+        return descriptor['Descriptor']['digest']
+
+    def node_image_digests(self, node, image):
+        try:
+            return [digest.split('@', 1)[1] for digest in self.node_engine(node).request('GET', '/images/{}/json'.format(image))['RepoDigests'] or []]
+        except EngineError as e:
+            if e.status == 404:
+                return []
+            raise
+
+    def pull_image(self, node, image):
+        repository, tag = split_image(image)
+        auth = registry_auth(image)
+        errors = []
+
+        # progress is streamed as a sequence of JSON objects; errors are reported in-band
+        def progress(line):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                return
+            if event.get('error'):
+                errors.append(event['error'])
+            elif event.get('status') and not event.get('progress'):
+                echo(' '.join(filter(None, [event.get('id'), event['status']])), node)
+
+        self.node_engine(node).request('POST', '/images/create', query={'fromImage': repository, 'tag': tag},
+                                                headers={'X-Registry-Auth': auth} if auth else None, on_line=progress)
+        if errors:
+            raise ComposeError(errors[0])
+
+
+def docker_backend(kind, command_timeout=None):
+    if kind == 'auto':
+        kind = 'engine' if not debug and DockerEngine.is_available() else 'cli'
+    return DockerEngine.from_env() if kind == 'engine' else DockerCli(command_timeout)
+
+
+class ComposeLoader:
+    """Decodes and merges compose files, parsing every file at most once per run and optionally caching the result on disk.
+
+    A cached model is reused while none of the files it was built from (`extends` ones included) and none of the
+    environment variables it depends on have changed.
+    """
+
+    cache_version = 1
+
+    def __init__(self, base_dir, cache_dir=None, keep_parsed=False):
+        self.base_dir = base_dir
+        self.cache_dir = cache_dir
+        self.parsed = {} if keep_parsed else None  # path -> parsed model, kept for loading again after some files changed
+        self.contents = {}  # path -> raw content
+        self.digests = OrderedDict()  # path -> sha256 of the content, for every file the model is built from
+        self.environment = {}  # variable -> value, for every variable the model depends on
+        self.extended_files = {}  # path -> (services, resolved services) of a file referenced by `extends`
+
+    def read(self, path):
+        path = os.path.abspath(path)
+        if path not in self.contents:
+            with open(path, 'rb') as compose_file:
+                self.contents[path] = compose_file.read()
+            self.digests[path] = hashlib.sha256(self.contents[path]).hexdigest()
+        return path, self.contents[path]
+
+    def parse(self, path):
+        if self.parsed is not None and os.path.abspath(path) in self.parsed:
+            # merging modifies the model in place
+            return copy.deepcopy(self.parsed[os.path.abspath(path)])
+        with span('parse ' + path):
+            model = interpolate(yaml.load(self.read(path)[1], yodl.OrderedDictYAMLLoader), self.environment)
+        if self.parsed is not None:
+            self.parsed[os.path.abspath(path)] = copy.deepcopy(model)
+        return model
+
+    def forget(self, paths):
+        """Drops what was read from the given files, so that the next load reads them again."""
+        for path in paths:
+            self.contents.pop(path, None)
+            self.digests.pop(path, None)
+            if self.parsed is not None:
+                self.parsed.pop(path, None)
+        self.extended_files.clear()
+
+    def load(self, paths):
+        with span('load compose files'):
+            cache_path = self.cache_path(paths)
+            compose = self.read_cache(cache_path) if cache_path else None
+
+            if compose is None:
+                files = [self.parse(path) for path in paths]
+                compose = merge_configs(files, rules=COMPOSE_MERGE_RULES) if len(files) > 1 else files[0]
+                with span('merge services'):
+                    compose['services'] = self.merge_services(compose.get('services', {}))
+                if cache_path:
+                    self.write_cache(cache_path, compose)
+
+            return compose
+
+    def merge_services(self, services):
+        """Resolves the `extends` of every service, bases first whatever order the services are declared in."""
+        resolved = {}
+        return OrderedDict((service, self.resolve_service(None, services, resolved, service, [])) for service in services)
+
+    def extended_file(self, path):
+        """Returns the services of a file referenced by `extends`, parsed once, and the ones resolved so far."""
+        if path not in self.extended_files:
+            self.extended_files[path] = (self.parse(path).get('services', {}), {})
+        return self.extended_files[path]
+
+    def resolve_service(self, path, services, resolved, service, chain):
+        """Returns the config of a service merged with the services it extends, resolving each of them once.
+
+        chain holds the (file, service) pairs being resolved, an `extends` pointing back at one of them is a cycle.
+        """
+        if service in resolved:
+            return resolved[service]
+        if (path, service) in chain:
+            raise ComposeError('services extend each other in a cycle: {}'.format(
+                ' -> '.join('{} in {}'.format(name, os.path.relpath(p, self.base_dir)) if p else name
+                            for p, name in chain[chain.index((path, service)):] + [(path, service)])))
+        if service not in services:
+            raise ComposeError('cannot extend service "{}": not found in {}'.format(
+                service, os.path.relpath(path, self.base_dir) if path else 'the compose files'))
+
+        config = services[service]
+        if 'extends' in config:
+            extended_config = config.pop('extends')
+            if 'file' in extended_config:
+                extended_path = os.path.abspath(self.base_dir + extended_config['file'])
+                extended_services, extended_resolved = self.extended_file(extended_path)
             else:
-                return stdout
+                extended_path, extended_services, extended_resolved = path, services, resolved
+            chain.append((path, service))
+            extended_service_data = self.resolve_service(extended_path, extended_services, extended_resolved,
+                                                         extended_config['service'], chain)
+            chain.pop()
+            config = merge_service_configs([config, extended_service_data], first_wins=True)
+
+        resolved[service] = config
+        return config
+
+    def cache_path(self, paths):
+        if not self.cache_dir:
+            return None
+        key = hashlib.sha256(str(self.cache_version).encode('utf-8'))
+        for path in paths:
+            path, content = self.read(path)
+            key.update(path.encode('utf-8') + b'\0' + content + b'\0')
+        return os.path.join(self.cache_dir, key.hexdigest() + '.json')
+
+    def read_cache(self, cache_path):
+        try:
+            with open(cache_path) as cache_file:
+                entry = json.load(cache_file, object_pairs_hook=OrderedDict)
+        except (IOError, OSError, ValueError):
+            return None
+
+        for path, digest in entry['inputs'].items():
+            try:
+                self.read(path)
+            except (IOError, OSError):
+                return None
+            if self.digests[path] != digest:
+                return None
+        for variable, value in entry['environment'].items():
+            if os.environ.get(variable) != value:
+                return None
+
+        self.environment.update(entry['environment'])
+        return entry['compose']
+
+    def write_cache(self, cache_path, compose):
+        entry = OrderedDict([('inputs', self.digests), ('environment', self.environment), ('compose', compose)])
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # written aside and renamed, so that concurrent runs never see a partial entry
+            temporary_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+            with open(temporary_path, 'w') as cache_file:
+                json.dump(entry, cache_file)
+            os.rename(temporary_path, cache_path)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            print('WARNING: cannot write compose cache {}: {}'.format(cache_path, e), file=sys.stderr)
+
+
+class ServiceConfig(object):
+    """A compose service normalized once and shared by the swarm and Kubernetes emitters."""
+
+    __slots__ = ('name', 'image', 'command', 'restart', 'log_driver', 'log_options', 'mem_limit', 'labels', 'mode', 'ports',
+                 'expose', 'networks', 'volumes', 'environment', 'env_file', 'constraints', 'replicas', 'container_name',
+                 'depends_on', 'links', 'wave', 'update_parallelism', 'update_delay')
+
+    def __init__(self, name):
+        self.name = name
+        self.image = None
+        self.command = []
+        self.restart = None
+        self.log_driver = None
+        self.log_options = OrderedDict()
+        self.mem_limit = None
+        self.labels = OrderedDict()
+        self.mode = None
+        self.ports = []
+        self.expose = []
+        self.networks = []
+        self.volumes = []  # (source, target, read only); the source of a bind mount is an absolute path
+        self.environment = []  # (name, value); value is None for variables passed through without one
+        self.env_file = []  # absolute paths
+        self.constraints = []
+        self.replicas = None
+        self.container_name = None
+        self.depends_on = []
+        self.links = []
+        self.wave = 0
+        self.update_parallelism = None
+        self.update_delay = None
+
+    @classmethod
+    def compile(cls, name, service_config, base_dir):
+        config = cls(name)
+        for key, value in service_config.items():
+            if key not in SERVICE_KEYS:
+                if key.startswith('x-'):  # extension keys of other tools
+                    continue
+                print('WARNING: unsupported parameter {}'.format(key), file=sys.stderr)
+            elif SERVICE_KEYS[key] is not None:
+                SERVICE_KEYS[key](config, value, base_dir)
+        return config
+
+    def variables(self):
+        # `environment` takes precedence over `env_file`, whatever the order of the keys
+        variables = OrderedDict((k, os.environ.get(k) if v is None else v) for path in self.env_file for k, v in read_env_file(path))
+        variables.update(self.environment)
+        return list(variables.items())
+
+    def desired_replicas(self):
+        # `replicas: 0` is kept, a service is just not started then
+        return 1 if self.replicas is None else self.replicas
+
+    def named_volumes(self):
+        return [source for source, _, _ in self.volumes if not source.startswith('/')]
+
+
+def set_field(field, convert=lambda value: value):
+    def handler(config, value, base_dir):
+        setattr(config, field, convert(value))
+    return handler
+
+
+def compile_logging(config, value, base_dir):
+    config.log_driver = value.get('driver', 'json-file')
+    config.log_options.update((k, v) for k, v in (value.get('options') or {}).items() if v is not None)
+
+
+def compile_labels(config, value, base_dir):
+    config.labels.update(value.items() if isinstance(value, dict) else (label.partition('=')[::2] for label in value))
+
+
+def compile_volumes(config, value, base_dir):
+    for volume in value:
+        splitted_volume = volume.split(':')
+        src = splitted_volume.pop(0)
+        dst = splitted_volume.pop(0)
+        if src.startswith('.'):
+            src = os.path.normpath(os.path.join(base_dir, src))
+        config.volumes.append((src, dst, bool(splitted_volume) and splitted_volume[0] == 'ro'))
+
+
+def compile_environment(config, value, base_dir):
+    if isinstance(value, dict):
+        entries = [(k, None if v is None else str(v)) for k, v in value.items()]
+    else:
+        entries = []
+        for env in value:
+            if env.startswith('constraint') or env.startswith('affinity'):
+                config.constraints.append(env.split(':', 1)[1])
+            else:
+                k, separator, v = env.partition('=')
+                entries.append((k, v if separator else None))
+    config.environment.extend((k, os.environ.get(k) if v is None else v) for k, v in entries)
+
+
+def compile_env_file(config, value, base_dir):
+    for path in [value] if isinstance(value, string_types) else value:
+        path = os.path.normpath(os.path.join(base_dir, path))
+        read_env_file(path)  # fail early on a missing file
+        config.env_file.append(path)
+
+
+def compile_rollout(config, value, base_dir):
+    for key, setting in (value or {}).items():
+        if key == 'wave':
+            config.wave = int(setting)
+        elif key == 'update_parallelism':
+            config.update_parallelism = int(setting)
+        elif key == 'update_delay':
+            parse_duration(setting)  # fail early on an invalid one
+            config.update_delay = str(setting)
+        else:
+            print('WARNING: unsupported parameter x-rollout.{}'.format(key), file=sys.stderr)
+
+
+def compile_list(value):
+    return list(value.keys() if isinstance(value, dict) else value)
+
+
+SERVICE_KEYS = {
+    'image': set_field('image'),
+    'command': set_field('command', lambda value: list(value) if isinstance(value, list) else value.split(' ')),
+    'restart': set_field('restart'),
+    'logging': compile_logging,
+    'mem_limit': set_field('mem_limit'),
+    'labels': compile_labels,
+    'mode': set_field('mode'),
+    'ports': set_field('ports', compile_list),
+    'expose': set_field('expose', compile_list),
+    'networks': set_field('networks', compile_list),
+    'volumes': compile_volumes,
+    'environment': compile_environment,
+    'env_file': compile_env_file,
+    'replicas': set_field('replicas', int),
+    'container_name': set_field('container_name'),
+    'depends_on': set_field('depends_on', compile_list),
+    'links': set_field('links', lambda value: [link.split(':')[0] for link in value]),
+    'x-rollout': compile_rollout,
+    'extra_hosts': None,  # unsupported by both docker service and Kubernetes
+    'hostname': None,  # unsupported; waiting for https://github.com/docker/docker/issues/24877
+}
+
+RESTART_CONDITIONS = {'always': 'any', 'unless-stopped': 'any', 'on-failure': 'on-failure', 'no': 'none'}
+RESTART_POLICIES = {'always': 'Always', 'unless-stopped': 'Always', 'on-failure': 'OnFailure', 'no': 'Never'}
+
+
+class DockerCompose:
+    def __init__(self, compose, project, compose_base_dir, requested_services, parallel=1, backend=None, parallel_per_node=1,
+                 wait=False, timeout=None, state=None, output_dir=None, plan_file=None, waves=False,
+                 require_fit=False):
+        self.project = project
+        self.parallel = parallel
+        self.parallel_per_node = parallel_per_node
+        self.wait = wait
+        self.timeout = timeout
+        self.backend = backend or DockerCli()
+        self.compose_base_dir = compose_base_dir
+        self.services = compose.get('services', OrderedDict())
+        self.networks = compose.get('networks', {})
+        self.volumes = compose.get('volumes', {})
+        self.filtered_services = [service for service in self.services if not requested_services or service in requested_services]
+        self.state = state
+        self.output_dir = output_dir
+        self.plan_file = plan_file
+        self.waves = waves
+        self.require_fit = require_fit
+        self.configs = {}
+
+    def project_prefix(self, value):
+        return '{}_{}'.format(self.project, value) if self.project else value
+
+    def execute(self, tasks, dependencies=None, workers=None):
+        check_results(Executor(workers or self.parallel).run(tasks, dependencies))
+
+    def cluster_state(self):
+        if self.state is None:
+            self.state = ClusterState.fetch(self.backend)
+        return self.state
+
+    def service_config(self, service):
+        if service not in self.configs:
+            self.configs[service] = ServiceConfig.compile(service, self.services[service], self.compose_base_dir)
+        return self.configs[service]
 
     def is_service_exists(self, service):
-        return self.call('/bin/bash -o pipefail -c "docker service ls | awk \'{{print \\$2}}\' | (egrep \'^{}$\' || :)"'.format(self.project_prefix(service)))
+        return self.project_prefix(service) in self.cluster_state().services
 
     def is_external_network(self, network):
         if network not in self.networks:
-            print >> sys.stderr, ('Error: network "{}" is not defined in networks'.format(network))
-            sys.exit(1)
+            raise ComposeError('network "{}" is not defined in networks'.format(network))
         return isinstance(self.networks[network], dict) and 'external' in self.networks[network]
 
-    def up(self):
-        for network in self.networks:
-            if not self.is_external_network(network):
-                cmd = '[ "`docker network ls | awk \'{{print $2}}\' | egrep \'^{0}$\'`" != "" ] || docker network create --driver overlay --opt encrypted {0}' \
-                    .format(self.project_prefix(network))
-                self.call(cmd)
-
-        for volume in self.volumes:
-            cmd = '[ "`docker volume ls | awk \'{{print $2}}\' | egrep \'^{0}$\'`" != "" ] || docker volume create --name {0}' \
-                .format(self.project_prefix(volume))
-            if isinstance(self.volumes[volume], dict) and self.volumes[volume]['driver']:
-                cmd = cmd + ' --driver={0}'.format(self.volumes[volume]['driver'])
-            self.call(cmd)
+    def service_dependencies(self, service):
+        config = self.service_config(service)
+        return ['network ' + network for network in config.networks] + \
+               ['volume ' + volume for volume in config.named_volumes()] + \
+               ['service ' + dependency for dependency in config.depends_on + config.links]
+
+    def live_labels(self, service):
+        return self.cluster_state().services[self.project_prefix(service)].get('Spec', {}).get('Labels') or {}
+
+    def is_image_changed(self, service, image):
+        live_image = self.cluster_state().services[self.project_prefix(service)].get('Spec', {}).get('TaskTemplate', {}) \
+            .get('ContainerSpec', {}).get('Image')
+        if not live_image:
+            return False
+        # the swarm pins the image to the digest it resolved when the service was created
+        if '@' not in image:
+            live_image = live_image.split('@', 1)[0]
+        return tuple(split_image(live_image)) != tuple(split_image(image))
+
+    def live_replicas(self, service):
+        mode = self.cluster_state().services[self.project_prefix(service)].get('Spec', {}).get('Mode', {})
+        return mode['Replicated'].get('Replicas') if 'Replicated' in mode else None
 
-        services_to_start = []
+    def up(self):
+        with span('plan'):
+            plan = self.up_plan()
+        self.check_fit()
+        if self.waves:
+            self.roll_out(plan)
+            return
+        apply_plan(self.backend, plan, self.parallel)
+        self.wait_for_convergence(plan_services(plan))
+
+    def roll_out(self, plan):
+        """Applies a plan wave by wave, starting each wave once the services of the previous one have converged."""
+        configs = dict((self.project_prefix(service), self.service_config(service)) for service in self.filtered_services)
+        waves = rollout_waves(plan, configs, self.cluster_state().nodes)
+        started = time.time()
+
+        for index, wave in enumerate(waves, 1):
+            names = plan_services(wave)
+            print('Wave {}/{}: {}'.format(index, len(waves), ', '.join(names) or 'networks and volumes'))
+            sys.stdout.flush()
+            with span('wave {}'.format(index)):
+                apply_plan(self.backend, wave, self.parallel)
+                if names and not debug:
+                    timeout = self.timeout and max(self.timeout - (time.time() - started), 0.001)
+                    wait_for_services(self.backend, names, timeout)
 
-        for service in self.filtered_services:
-            if self.is_service_exists(service):
-                services_to_start.append(service)
-                continue
+        if not debug:
+            print('Rolled out {} services in {} waves, converged in {:.1f}s'.format(
+                sum(len(plan_services(wave)) for wave in waves), len(waves), time.time() - started))
+
+    def reconcile(self):
+        """Brings the services up, then keeps them in line with the compose files for as long as it runs.
+
+        Instead of polling, the swarm's service events are followed: only the service an event is about is inspected
+        again, and acted upon if it was removed, scaled, or updated with another image or configuration.
+        """
+        targets = dict((self.project_prefix(service), service) for service in self.filtered_services)
+
+        def on_event(event):
+            name = (event.get('Actor') or {}).get('Attributes', {}).get('name')
+            if name not in targets:
+                return
+            live = self.backend.find_service(name) if event.get('Action') != 'remove' else None
+            if live is None:
+                self.state.services.pop(name, None)
+            else:
+                self.state.services[name] = live
+            self.enforce([targets[name]])
 
-            service_config = self.services[service]
-            cmd = ['docker service create --with-registry-auth \\\n --name', self.project_prefix(service), '\\\n']
+        try:
+            while True:
+                since = int(time.time()) - 10
+                self.state = ClusterState.fetch(self.backend)
+                self.enforce(self.filtered_services)
+                if debug:
+                    return
+                print('Watching service events')
+                sys.stdout.flush()
+                try:
+                    # events since shortly before the model was fetched, so none is missed however the clocks differ; the
+                    # model is fetched again after an interruption
+                    self.backend.events(['service'], on_event, since)
+                except ComposeError as e:
+                    print('ERROR: {}'.format(e), file=sys.stderr)
+                time.sleep(5)
+        except KeyboardInterrupt:
+            pass
+
+    def enforce(self, services):
+        """Applies whatever the given services need to match the compose files; failures are reported, not raised."""
+        plan = self.up_plan(services)
+        if all(action['action'] == 'skip' for action in plan['actions']):
+            return
+        print_plan(plan)
+        try:
+            apply_plan(self.backend, plan, self.parallel)
+        except ComposeError as e:
+            print('ERROR: {}'.format(e), file=sys.stderr)
+        # the next events are planned against the state, which has to know the networks and volumes created by now
+        if any(action['action'] in ('create network', 'create volume') for action in plan['actions']) and not debug:
+            try:
+                self.state.networks = self.backend.list_networks()
+                self.state.volumes = set(self.backend.list_volumes())
+            except ComposeError as e:
+                print('ERROR: {}'.format(e), file=sys.stderr)
+
+    def plan(self):
+        plan = self.up_plan()
+        print_plan(plan)
+        self.check_fit()
+        with open(self.plan_file, 'w') as plan_file:
+            json.dump(plan, plan_file, separators=(',', ':'))
+        print('Plan written to {}, run it with `apply {}`'.format(self.plan_file, self.plan_file))
+
+    def check_fit(self):
+        """Reports the services whose memory limits do not fit on the nodes, failing if a fit is required."""
+        check_fit([(self.project_prefix(service), self.service_config(service)) for service in self.filtered_services],
+                  self.cluster_state().nodes, self.require_fit)
+
+    def up_plan(self, services=None):
+        """Returns the actions bringing the cluster (or just the given services) in line with the compose files, as a
+        plan that can be saved as JSON."""
+        state = self.cluster_state()
+        actions = []
 
-            service_image = []
-            service_command = []
+        for network in self.networks:
+            if not self.is_external_network(network) and self.project_prefix(network) not in state.networks:
+                actions.append(OrderedDict([('name', 'network ' + network), ('action', 'create network'),
+                                            ('target', self.project_prefix(network))]))
 
-            def add_flag(key, value):
-                cmd.extend([key, shellquote(value), '\\\n'])
+        for volume in self.volumes:
+            if self.project_prefix(volume) not in state.volumes:
+                driver = self.volumes[volume].get('driver') if isinstance(self.volumes[volume], dict) else None
+                actions.append(OrderedDict([('name', 'volume ' + volume), ('action', 'create volume'),
+                                            ('target', self.project_prefix(volume)), ('driver', driver)]))
+
+        for service in self.filtered_services if services is None else services:
+            flags, image, command, config_hash = self.service_definition(service)
+            config = self.service_config(service)
+
+            action = OrderedDict([('name', 'service ' + service), ('action', 'skip'), ('target', self.project_prefix(service))])
+            if not self.is_service_exists(service) or self.live_labels(service).get(CONFIG_HASH_LABEL) != config_hash or \
+                    self.is_image_changed(service, image):
+                action.update([('flags', flags), ('image', image), ('command', command),
+                               ('depends_on', self.service_dependencies(service))])
+                if config.env_file:
+                    # env files are read again when the plan is carried out, they have to be the ones reviewed
+                    action['env_files'] = OrderedDict((path, env_file_digest(path)) for path in config.env_file)
+                if not self.is_service_exists(service):
+                    action['action'] = 'create service'
+                else:
+                    current = state.services[self.project_prefix(service)]
+                    action['action'] = 'update service'
+                    action['current'] = dict((key, current[key]) for key in ('ID', 'Version', 'Spec') if key in current)
+            # global services have no replicas to scale back
+            elif config.mode != 'global' and self.live_replicas(service) not in (None, config.desired_replicas()):
+                action.update([('action', 'scale service'), ('replicas', config.desired_replicas())])
+            actions.append(action)
+
+        return OrderedDict([('version', PLAN_VERSION), ('project', self.project), ('networks', state.networks), ('actions', actions)])
+
+    def service_definition(self, service):
+        """Returns the flags (including the config hash label), image, command, and config hash of the service."""
+        flags, image, command = self.service_flags(service)
+        config = self.service_config(service)
+        # env files are passed by path, their content has to be part of the hash too
+        config_hash = hashlib.sha256(json.dumps([flags, image, command] + ([config.variables()] if config.env_file else []))
+                                     .encode('utf-8')).hexdigest()
+        # stored as a label, so that the next `up` can tell whether the service has to be updated
+        flags.append(('--label', '{}={}'.format(CONFIG_HASH_LABEL, config_hash)))
+        return flags, image, command, config_hash
+
+    def service_flags(self, service):
+        """Returns the `docker service create` flags, image, and command of the service."""
+        config = self.service_config(service)
+        flags = []
+
+        if config.image is None:
+            raise ComposeError('no image specified for %s service' % service)
+
+        if config.restart is not None:
+            if config.restart not in RESTART_CONDITIONS:
+                raise ComposeError('unsupported restart policy "{}" of {} service'.format(config.restart, service))
+            flags.append(('--restart-condition', RESTART_CONDITIONS[config.restart]))
+        if config.log_driver is not None:
+            flags.append(('--log-driver', config.log_driver))
+            flags.extend(('--log-opt', '{}={}'.format(k, v)) for k, v in config.log_options.items())
+        if config.mem_limit is not None:
+            flags.append(('--limit-memory', config.mem_limit))
+        flags.extend(('--label', '{}={}'.format(k, v)) for k, v in config.labels.items())
+        if config.mode is not None:
+            flags.append(('--mode', config.mode))
+        flags.extend(('--publish', port) for port in config.ports)
+        flags.extend(('--network', network if self.is_external_network(network) else self.project_prefix(network))
+                     for network in config.networks)
+        for src, dst, readonly in config.volumes:
+            if src.startswith('/'):
+                flags.append(('--mount', 'type=bind,src={},dst={},readonly={}'.format(src, dst, int(readonly))))
+            else:
+                flags.append(('--mount', 'src={},dst={},readonly={}'.format(self.project_prefix(src), dst, int(readonly))))
+        flags.extend(('--env-file', path) for path in config.env_file)
+        flags.extend(('--env', k if v is None else '{}={}'.format(k, v)) for k, v in config.environment)
+        flags.extend(('--constraint', constraint) for constraint in config.constraints)
+        if config.replicas is not None:
+            flags.append(('--replicas', config.replicas))
+        if config.update_parallelism is not None:
+            flags.append(('--update-parallelism', config.update_parallelism))
+        if config.update_delay is not None:
+            flags.append(('--update-delay', config.update_delay))
+
+        return flags, config.image, config.command
 
-            for parameter in service_config:
-                value = service_config[parameter]
+    def pull(self):
+        targets = pull_targets([self.service_config(service) for service in self.filtered_services], self.cluster_state().nodes)
+        print_pull_matrix(targets, self.cluster_state().nodes)
+        pull_images(self.backend, targets, self.parallel, self.parallel_per_node)
 
-                def restart():
-                    add_flag('--restart-condition', {'always': 'any'}[value])
+    def stop(self):
+        services = [self.project_prefix(service) for service in self.filtered_services if self.is_service_exists(service)]
+        if services:
+            check_results(self.backend.scale_services(OrderedDict((service, 0) for service in services), self.parallel))
+            self.wait_for_convergence(services)
 
-                def logging():
-                    add_flag('--log-driver', value.get('driver', 'json-file'))
-                    log_opts = value['options']
-                    if log_opts:
-                        for k, v in log_opts.items():
-                            if v is not None:
-                                add_flag('--log-opt', '{}={}'.format(k, v))
+    def rm(self):
+        services = [self.project_prefix(service) for service in self.filtered_services if self.is_service_exists(service)]
+        if services:
+            check_results(self.backend.remove_services(services, self.parallel))
 
-                def mem_limit():
-                    add_flag('--limit-memory', value)
+    def start(self, services=None):
+        if services is None:
+            services = self.filtered_services
 
-                def image():
-                    service_image.append(value)
+        replicas = self.desired_replicas(services)
+        check_results(self.backend.scale_services(replicas, self.parallel))
+        self.wait_for_convergence(list(replicas))
 
-                def command():
-                    if isinstance(value, list):
-                        service_command.extend(value)
-                    else:
-                        service_command.extend(value.split(' '))
-
-                def expose():
-                    pass  # unsupported
-
-                def container_name():
-                    pass  # unsupported
-
-                def hostname():
-                    pass  # unsupported; waiting for https://github.com/docker/docker/issues/24877
-
-                def labels():
-                    value = service_config[parameter]
-                    # ^ working-around the lack of `nonlocal` statement.
-                    if isinstance(value, dict):
-                        value = ('%s=%s' % i for i in value.iteritems())
-
-                    for label in value:
-                        add_flag('--label', label)
-
-                def mode():
-                    add_flag('--mode', value)
-
-                def extra_hosts():
-                    pass  # unsupported
-
-                def ports():
-                    for port in value:
-                        add_flag('--publish', port)
-
-                def networks():
-                    for network in value:
-                        add_flag('--network', network if self.is_external_network(network) else self.project_prefix(network))
-
-                def volumes():
-                    for volume in value:
-                        splitted_volume = volume.split(':')
-                        src = splitted_volume.pop(0)
-                        dst = splitted_volume.pop(0)
-                        readonly = 0
-                        if splitted_volume and splitted_volume[0] == 'ro':
-                            readonly = 1
-                        if src.startswith('.'):
-                            src = src.replace('.', self.compose_base_dir, 1)
-
-                        if src.startswith('/'):
-                            add_flag('--mount', 'type=bind,src={},dst={},readonly={}'.format(src, dst, readonly))
-                        else:
-                            add_flag('--mount', 'src={},dst={},readonly={}'.format(self.project_prefix(src), dst, readonly))
-
-                def environment():
-                    if isinstance(value, dict):
-                        for k, v in value.items():
-                            add_flag('--env', '{}={}'.format(k, v))
-                    else:
-                        for env in value:
-                            if env.startswith('constraint') or env.startswith('affinity'):
-                                constraint = env.split(':', 2)[1]
-                                add_flag('--constraint', constraint)
-                            else:
-                                add_flag('--env', env)
+    def desired_replicas(self, services):
+        return OrderedDict((self.project_prefix(service), self.service_config(service).desired_replicas()) for service in services)
 
-                def replicas():
-                    add_flag('--replicas', value)
+    def wait_for_convergence(self, names):
+        """With --wait, blocks until every service runs as many tasks as it should and reports how long it took."""
+        if self.wait and not debug and names:
+            wait_for_services(self.backend, names, self.timeout)
 
-                def env_file():
-                    for v in value:
-                        with open(v) as env_file:
-                            for line in env_file:
-                                if not line.startswith('#') and line.strip():
-                                    add_flag('--env', line.strip())
+    def kubernetes_objects(self, service):
+        """Returns the Kubernetes Service and Deployment for the service."""
+        config = self.service_config(service)
 
+        def project_prefix(value):
+            return '{}-{}'.format(self.project, value) if self.project else value
 
-                def unsupported():
-                    print >> sys.stderr, ('WARNING: unsupported parameter {}'.format(parameter))
+        service = service.replace('_', '-')
+        service_result = OrderedDict([
+            ('apiVersion', 'v1'),
+            ('kind', 'Service'),
+            ('metadata', OrderedDict([
+                ('name', project_prefix(service)),
+                ('labels', OrderedDict())
+            ])),
+            ('spec', OrderedDict([
+                ('selector', OrderedDict())
+            ]))
+        ])
+        deployment_result = OrderedDict([
+            ('apiVersion', 'extensions/v1beta1'),
+            ('kind', 'Deployment'),
+            ('metadata', OrderedDict([
+                ('name', project_prefix(service))
+            ])),
+            ('spec', OrderedDict([
+                ('replicas', config.desired_replicas()),
+                ('template', OrderedDict([
+                    ('metadata', OrderedDict([
+                        ('labels', OrderedDict())
+                    ])),
+                    ('spec', OrderedDict([
+                        ('containers', [OrderedDict([
+                            ('name', project_prefix(service)),
+                        ])])
+                    ]))
+                ]))
+            ]))
+        ])
+
+        service_labels = service_result['metadata']['labels']
+        service_selector = service_result['spec']['selector']
+        deployment_labels = deployment_result['spec']['template']['metadata']['labels']
+        deployment_spec = deployment_result['spec']['template']['spec']
+        container = deployment_result['spec']['template']['spec']['containers'][0]
+
+        service_labels['service'] = self.project
+        service_labels['app'] = service
+
+        # TODO labels, mode, ports
+        if config.container_name is not None:
+            service_result['metadata']['name'] = config.container_name
+            deployment_result['metadata']['name'] = config.container_name
+            container['name'] = config.container_name
+            service_labels['app'] = config.container_name
+
+        if config.restart is not None:
+            if config.restart not in RESTART_POLICIES:
+                raise ComposeError('unsupported restart policy "{}" of {} service'.format(config.restart, service))
+            deployment_spec['restartPolicy'] = RESTART_POLICIES[config.restart]
+
+        if config.mem_limit is not None:
+            container['resources'] = {'limits': {'memory': str(config.mem_limit).replace('m', 'Mi').replace('g', 'Gi')}}
+
+        if config.image is not None:
+            container['image'] = config.image
+
+        if config.command:
+            container['args'] = config.command
+
+        if config.expose:
+            service_result['spec']['ports'] = []
+            container['ports'] = []
+            for port in config.expose:
+                port_int = int(port)
+                service_result['spec']['ports'].append(OrderedDict([('port', port_int), ('targetPort', port_int), ('name', str(port_int))]))
+                container['ports'].append({'containerPort': port_int})
+
+        if config.volumes:
+            container['volumeMounts'] = []
+            deployment_spec['volumes'] = []
+            for src, dst, readonly in config.volumes:
+                # TODO readonly
+                if src.startswith('/'):
+                    volume_name = src.split('/')[-1].replace('.', '').replace('_', '-')
+                    host_path = src
+                else:
+                    volume_name = src.replace('_', '-')
+                    host_path = '/volumes/' + project_prefix(volume_name)
+                container['volumeMounts'].append(OrderedDict([('name', volume_name), ('mountPath', dst)]))
+                deployment_spec['volumes'].append(OrderedDict([('name', volume_name), ('hostPath', {'path': host_path})]))
 
-                locals().get(parameter, unsupported)()
+        if config.variables():
+            container['env'] = [OrderedDict([('name', k), ('value', v or '')]) for k, v in config.variables()]
 
-            if len(service_image) == 0:
-                print('ERROR: no image specified for %s service' % service)
-                sys.exit(1)
+        for constraint in config.constraints:
+            selector = 'FIX_ME'
 
-            cmd.extend(service_image)
-            cmd.extend(service_command)
+            if constraint.startswith('node.hostname=='):
+                selector = 'kubernetes.io/hostname'
+                constraint = constraint.split('==')[1]
 
-            self.call(' '.join(cmd))
+            if constraint.startswith('engine.labels.'):
+                [selector, constraint] = constraint.split('==')
+                selector = selector.replace('engine.labels.', '')
 
-        if services_to_start:
-            self.start(services_to_start)
+            deployment_spec.setdefault('nodeSelector', OrderedDict())[selector] = constraint
 
-    def pull(self):
-        nodes = self.call("docker node ls | grep Ready | awk -F'[[:space:]][[:space:]]+' '{print $2}'").rstrip().split('\n')
+        service_selector.update(service_labels)
+        deployment_labels.update(service_labels)
 
-        threads = []
+        return service_result, deployment_result
 
-        for node in nodes:
-            cmd = '; '.join(['docker -H tcp://{}:2375 pull {}'.format(node, self.services[service]['image']) for service in self.filtered_services])
-            threads.append((node, threading.Thread(target=self.call, args=(cmd,))))
+    def kubernetes_yaml(self, service):
+        return ''.join(yaml.dump(result, Dumper=KubernetesDumper, default_flow_style=False) + '---\n'
+                       for result in self.kubernetes_objects(service))
 
-        for node, thread in threads:
-            print('Pulling on node {}'.format(node))
-            thread.start()
+    def convert(self):
+        if self.networks:
+            print('WARNING: unsupported parameter "networks"', file=sys.stderr)
 
-        for node, thread in threads:
-            thread.join()
-            print('Node {} - DONE'.format(node))
+        for volume in self.volumes:
+            print('WARNING: unsupported parameter "volumes"', file=sys.stderr)
+
+        services = self.filtered_services
+        processes = self.parallel
+        if processes is None:
+            processes = multiprocessing.cpu_count() if len(services) >= CONVERT_POOL_THRESHOLD else 1
+        pool = None
+        if processes > 1 and len(services) > 1:
+            # services are rendered in worker processes but come back in order, as soon as each one is ready
+            pool = multiprocessing.Pool(processes, init_convert_worker,
+                                        ({'services': self.services, 'networks': self.networks, 'volumes': self.volumes},
+                                         self.project, self.compose_base_dir))
+            documents = pool.imap(convert_service, services, chunksize=max(1, len(services) // (processes * 4)))
+        else:
+            documents = (self.kubernetes_yaml(service) for service in services)
 
-    def stop(self):
-        services = filter(self.is_service_exists, self.filtered_services)
-        cmd_args = ['{}={}'.format(self.project_prefix(service), 0) for service in services]
-        if cmd_args:
-            self.call('docker service scale ' + ' '.join(cmd_args))
+        written = 0
+        if self.output_dir is not None and not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        try:
+            for service, document in zip(services, documents):
+                if self.output_dir is None:
+                    sys.stdout.write(document)
+                    continue
+                path = os.path.join(self.output_dir, '{}.yml'.format(self.project_prefix(service).replace('_', '-')))
+                try:
+                    with open(path) as existing_file:
+                        unchanged = existing_file.read() == document
+                except (IOError, OSError):
+                    unchanged = False
+                if not unchanged:
+                    with open(path, 'w') as output_file:
+                        output_file.write(document)
+                    written += 1
+        except BaseException:
+            if pool is not None:
+                pool.terminate()
+            raise
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-    def rm(self):
-        services = filter(self.is_service_exists, self.filtered_services)
-        cmd_args = [self.project_prefix(service) for service in services]
-        if cmd_args:
-            self.call('docker service rm ' + ' '.join(cmd_args))
+        if self.output_dir is not None:
+            print('Wrote {} of {} files to {}, the rest are unchanged'.format(written, len(services), self.output_dir))
 
-    def start(self, services=None):
-        if services is None:
-            services = self.filtered_services
 
-        cmd = 'docker service scale ' + \
-              ' '.join(['{}={}'.format(self.project_prefix(service), self.services[service].get('replicas', '1')) for service in services])
-        self.call(cmd)
+class KubernetesDumper(getattr(yaml, 'CSafeDumper', yaml.SafeDumper)):
+    """Dumps OrderedDicts as plain mappings, keeping the order of their keys; uses libyaml when available."""
 
-    def convert(self):
-        # Based on http://stackoverflow.com/a/8661021
-        represent_dict_order = lambda _self, data: _self.represent_mapping('tag:yaml.org,2002:map', data.items())
-        yaml.add_representer(OrderedDict, represent_dict_order)
 
-        def project_prefix(value):
-            return '{}-{}'.format(self.project, value) if self.project else value
+# Based on http://stackoverflow.com/a/8661021
+KubernetesDumper.add_representer(OrderedDict, lambda dumper, data: dumper.represent_mapping('tag:yaml.org,2002:map', data.items()))
 
-        if self.networks:
-            print >> sys.stderr, ('WARNING: unsupported parameter "networks"')
+convert_worker = None
 
-        for volume in self.volumes:
-            print >> sys.stderr, ('WARNING: unsupported parameter "volumes"')
-
-        for service in self.filtered_services:
-            service_config = self.services[service]
-            service = service.replace('_', '-')
-            service_result = OrderedDict([
-                ('apiVersion', 'v1'),
-                ('kind', 'Service'),
-                ('metadata', OrderedDict([
-                    ('name', project_prefix(service)),
-                    ('labels', OrderedDict())
-                ])),
-                ('spec', OrderedDict([
-                    ('selector', OrderedDict())
-                ]))
-            ])
-            deployment_result = OrderedDict([
-                ('apiVersion', 'extensions/v1beta1'),
-                ('kind', 'Deployment'),
-                ('metadata', OrderedDict([
-                    ('name', project_prefix(service))
-                ])),
-                ('spec', OrderedDict([
-                    ('replicas', 1),
-                    ('template', OrderedDict([
-                        ('metadata', OrderedDict([
-                            ('labels', OrderedDict())
-                        ])),
-                        ('spec', OrderedDict([
-                            ('containers', [OrderedDict([
-                                ('name', project_prefix(service)),
-                            ])])
-                        ]))
-                    ]))
-                ]))
-            ])
 
-            service_labels = service_result['metadata']['labels']
-            service_selector = service_result['spec']['selector']
-            deployment_labels = deployment_result['spec']['template']['metadata']['labels']
-            deployment_spec = deployment_result['spec']['template']['spec']
-            container = deployment_result['spec']['template']['spec']['containers'][0]
+def init_convert_worker(compose, project, compose_base_dir):
+    global convert_worker
+    convert_worker = DockerCompose(compose, project, compose_base_dir, [])
 
-            service_labels['service'] = self.project
-            service_labels['app'] = service
 
-            for parameter in service_config:
-                value = service_config[parameter]
+def convert_service(service):
+    return convert_worker.kubernetes_yaml(service)
 
-                def restart():
-                    deployment_spec['restartPolicy'] = {'always': 'Always'}[value]
 
-                def logging():
-                    pass  # unsupported
+class SavedPlan:
+    """A plan saved by the plan command, carried out without the compose files and without querying the cluster again."""
 
-                def mem_limit():
-                    container['resources'] = {'limits': {'memory': value.replace('m', 'Mi').replace('g', 'Gi')}}
+    def __init__(self, path, backend, parallel=1, wait=False, timeout=None, **options):
+        try:
+            with open(path) as plan_file:
+                self.plan = json.load(plan_file, object_pairs_hook=OrderedDict)
+        except (IOError, OSError, ValueError) as e:
+            raise ComposeError('cannot read plan {}: {}'.format(path, e))
+        self.backend = backend
+        self.parallel = parallel
+        self.wait = wait
+        self.timeout = timeout
+
+    def apply(self):
+        print_plan(self.plan)
+        changed = [(action['target'], path) for action in self.plan['actions']
+                   for path, digest in (action.get('env_files') or {}).items() if env_file_digest(path) != digest]
+        if changed:
+            raise ComposeError('env files changed since the plan was made, make a new one: {}'.format(
+                ', '.join('{} ({})'.format(path, target) for target, path in changed)))
+        apply_plan(self.backend, self.plan, self.parallel)
+        if self.wait and not debug and plan_services(self.plan):
+            wait_for_services(self.backend, plan_services(self.plan), self.timeout)
+
+
+class FileWatcher:
+    """Waits until some of the watched files change, with inotify where it is available and by polling them otherwise.
+
+    The directories of the files are watched rather than the files themselves, so that files replaced by editors
+    (written aside and renamed over the original) are still followed.
+    """
+
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x2, 0x4, 0x8, 0x40, 0x80, 0x100, 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_CLOEXEC = 0o2000000
+    event = struct.Struct('iIII')  # wd, mask, cookie, length of the name that follows
+
+    def __init__(self, inotify=True, poll_interval=1, settle=0.2):
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.paths = set()
+        self.stats = {}  # path -> (mtime, size, inode), for polling
+        self.directories = {}  # watch descriptor -> directory
+        self.libc = None
+        self.fd = None
+        if inotify:
+            try:
+                self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+            except (AttributeError, OSError):
+                self.fd = None
+            if self.fd is not None and self.fd < 0:
+                self.fd = None
+
+    @property
+    def method(self):
+        return 'inotify' if self.fd is not None else 'polling every {}s'.format(self.poll_interval)
+
+    def watch(self, paths):
+        self.paths = set(os.path.abspath(path) for path in paths)
+        self.stats = dict((path, self.stat(path)) for path in self.paths)
+        if self.fd is None:
+            return
+        mask = self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | \
+            self.IN_DELETE
+        for directory in set(os.path.dirname(path) for path in self.paths) - set(self.directories.values()):
+            encoded = directory if isinstance(directory, bytes) else directory.encode(sys.getfilesystemencoding())
+            descriptor = self.libc.inotify_add_watch(self.fd, encoded, mask)
+            if descriptor < 0:
+                raise ComposeError('cannot watch {}: {}'.format(directory, os.strerror(ctypes.get_errno())))
+            self.directories[descriptor] = directory
+
+    def wait(self):
+        """Blocks until some of the watched files change and returns them."""
+        changed = set()
+        while not changed:
+            changed = self.read_events(None) if self.fd is not None else self.poll(self.poll_interval)
+        # editors and `git checkout` write several files in a row, they are picked up at once
+        time.sleep(self.settle)
+        changed |= self.read_events(0) if self.fd is not None else self.poll(0)
+        return sorted(changed)
+
+    def read_events(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self.fd, 65536)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, _cookie, length = self.event.unpack_from(data, offset)
+            name = data[offset + self.event.size:offset + self.event.size + length].rstrip(b'\0')
+            offset += self.event.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                return set(self.paths)
+            if descriptor in self.directories and name:
+                path = os.path.join(self.directories[descriptor], name.decode(sys.getfilesystemencoding()))
+                if path in self.paths:
+                    changed.add(path)
+        return changed
+
+    def poll(self, interval):
+        time.sleep(interval)
+        changed = set()
+        for path in self.paths:
+            stat = self.stat(path)
+            if stat != self.stats.get(path):
+                self.stats[path] = stat
+                changed.add(path)
+        return changed
 
-                def image():
-                    container['image'] = value
+    @staticmethod
+    def stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size, stat.st_ino
 
-                def command():
-                    if isinstance(value, list):
-                        container['args'] = value
-                    else:
-                        container['args'] = value.split(' ')
-
-                def expose():
-                    service_result['spec']['ports'] = []
-                    container['ports'] = []
-                    for port in value:
-                        port_int = int(port)
-                        service_result['spec']['ports'].append(OrderedDict([('port', port_int), ('targetPort', port_int), ('name', str(port_int))]))
-                        container['ports'].append({'containerPort': port_int})
-
-                def container_name():
-                    service_result['metadata']['name'] = value
-                    deployment_result['metadata']['name'] = value
-                    container['name'] = value
-                    service_labels['app'] = value
-
-                def hostname():
-                    pass  # unsupported
-
-                def labels():
-                    pass  # TODO
-
-                def mode():
-                    pass  # TODO
-
-                def extra_hosts():
-                    pass  # unsupported
-
-                def ports():
-                    for port in value:
-                        pass  # TODO
-
-                def networks():
-                    pass  # unsupported
-
-                def volumes():
-                    container['volumeMounts'] = []
-                    deployment_spec['volumes'] = []
-                    for volume in value:
-                        splitted_volume = volume.split(':')
-                        src = splitted_volume.pop(0)
-                        dst = splitted_volume.pop(0)
-                        readonly = 0
-                        if splitted_volume and splitted_volume[0] == 'ro':
-                            readonly = 1
-                        if src.startswith('.'):
-                            src = src.replace('.', self.compose_base_dir, 1)
-
-                        if src.startswith('/'):
-                            volume_name = src.split('/')[-1].replace('.', '').replace('_', '-')
-                            container['volumeMounts'].append(OrderedDict([('name', volume_name), ('mountPath', dst)]))
-                            deployment_spec['volumes'].append(OrderedDict([('name', volume_name), ('hostPath', {'path': src})]))
-                            # TODO readonly
-                        else:
-                            volume_name = src.replace('_', '-')
-                            container['volumeMounts'].append(OrderedDict([('name', volume_name), ('mountPath', dst)]))
-                            deployment_spec['volumes'].append(
-                                OrderedDict([('name', volume_name), ('hostPath', {'path': '/volumes/' + project_prefix(volume_name)})]))
-                            # TODO readonly
-
-                def environment():
-                    if isinstance(value, dict):
-                        container['env'] = []
-                        for k, v in value.items():
-                            container['env'].append(OrderedDict([('name', k), ('value', v)]))
-                    else:
-                        for env in value:
-                            if env.startswith('constraint') or env.startswith('affinity'):
-                                if 'nodeSelector' not in deployment_spec:
-                                    deployment_spec['nodeSelector'] = OrderedDict()
 
-                                constraint = env.split(':', 2)[1]
-                                selector = 'FIX_ME'
+class ComposeWatch:
+    """Keeps the compose model in memory and brings up the services whose configuration changed whenever a compose
+    file, a file referenced by `extends`, or an env file is saved.
 
-                                if constraint.startswith('node.hostname=='):
-                                    selector = 'kubernetes.io/hostname'
-                                    constraint = constraint.split('==')[1]
+    Only the changed files are parsed again, and only the services whose configuration hash differs from the one
+    brought up last time are planned and applied.
+    """
 
-                                if constraint.startswith('engine.labels.'):
-                                    [selector, constraint] = constraint.split('==')
-                                    selector = selector.replace('engine.labels.', '')
+    def __init__(self, paths, project, compose_base_dir, requested_services, backend=None, cache_dir=None, poll=False, **options):
+        self.paths = paths
+        self.project = project
+        self.compose_base_dir = compose_base_dir
+        self.requested_services = requested_services
+        self.backend = backend or DockerCli()
+        self.options = options
+        self.loader = ComposeLoader(compose_base_dir, cache_dir, keep_parsed=True)
+        self.watcher = FileWatcher(inotify=not poll)
+
+    def watch(self):
+        applied = {}
+        try:
+            while True:
+                try:
+                    applied = self.reconcile(applied)
+                except (ComposeError, yaml.YAMLError) as e:
+                    if not self.watcher.paths:
+                        raise
+                    print('ERROR: {}'.format(e), file=sys.stderr)
+
+                print('Watching {} files for changes ({}), press Ctrl+C to stop'.format(len(self.watcher.paths), self.watcher.method))
+                sys.stdout.flush()
+                changed = self.watcher.wait()
+                print('Changed: {}'.format(', '.join(os.path.relpath(path, self.compose_base_dir) for path in changed)))
+                for path in changed:
+                    env_files.pop(path, None)
+                self.loader.forget(changed)
+        except KeyboardInterrupt:
+            pass
+
+    def reconcile(self, applied):
+        """Brings up the services whose configuration hash differs from the applied one and returns the new hashes."""
+        try:
+            compose = DockerCompose(self.loader.load(self.paths), self.project, self.compose_base_dir, self.requested_services,
+                                    backend=self.backend, **self.options)
+            hashes = OrderedDict((service, compose.service_definition(service)[3]) for service in compose.filtered_services)
+        except Exception:
+            # the files of the last good model stay watched until the error is fixed
+            self.watcher.watch(self.watcher.paths | set(self.loader.digests))
+            raise
+        self.watcher.watch(list(self.loader.digests) + [path for config in compose.configs.values() for path in config.env_file])
+
+        for service in applied:
+            if service not in hashes:
+                print('Service {} is no longer in the compose files, left running (use rm to remove it)'.format(service))
+
+        changed = [service for service in hashes if applied.get(service) != hashes[service]]
+        if not changed:
+            print('No service configuration changed')
+            return hashes
+
+        # the cluster is queried again, every update needs the current version of its service
+        compose.filtered_services = changed
+        compose.up()
+        return hashes
+
+
+class ComposeProjects:
+    """Runs a command for several compose projects at once.
+
+    The projects share one view of the cluster, queried once, and one pool of workers; services of all the projects
+    are scaled or removed with a single command.
+    """
+
+    def __init__(self, projects, parallel=1, parallel_per_node=1, wait=False, timeout=None, require_fit=False):
+        self.projects = projects
+        self.parallel = parallel
+        self.parallel_per_node = parallel_per_node
+        self.wait = wait
+        self.timeout = timeout
+        self.require_fit = require_fit
+
+    @classmethod
+    def from_manifest(cls, path, cache_dir=None, backend=None, **options):
+        """Loads the projects listed in a YAML (or JSON) manifest:
+
+            projects:
+              - name: shop
+                files: [shop/docker-compose.yml, shop/docker-compose.prod.yml]
+                services: [web, worker]  # optional, all the services by default
+
+        Paths are relative to the directory of the manifest.
+        """
+        base_dir = os.path.dirname(os.path.abspath(path))
+        with open(path) as manifest_file:
+            manifest = yaml.load(manifest_file, yodl.OrderedDictYAMLLoader)
+
+        backend = backend or DockerCli()
+        state = ClusterState.fetch(backend)
+        projects = []
+        for entry in (manifest or {}).get('projects') or []:
+            if not entry.get('files'):
+                raise ComposeError('project "{}" in {} has no compose files'.format(entry.get('name', ''), path))
+            files = [os.path.join(base_dir, f) for f in entry['files']]
+            compose_base_dir = os.path.dirname(files[0]) + '/'
+            name = entry.get('name', os.path.basename(os.path.dirname(files[0])))
+            if name in [project.project for project in projects]:
+                raise ComposeError('project "{}" is listed twice in {}'.format(name, path))
+            compose = ComposeLoader(compose_base_dir, cache_dir).load(files)
+            projects.append(DockerCompose(compose, name, compose_base_dir, entry.get('services') or [], backend=backend,
+                                          state=state, **options))
+        if not projects:
+            raise ComposeError('no projects listed in {}'.format(path))
+
+        return cls(projects, **options)
+
+    @property
+    def backend(self):
+        return self.projects[0].backend
 
-                                deployment_spec['nodeSelector'][selector] = constraint
-                            else:
-                                if 'env' not in container:
-                                    container['env'] = []
+    def up(self):
+        tasks = OrderedDict()
+        dependencies = {}
+        owners = {}
+        replicas = OrderedDict()
+        changed = []
+
+        for project in self.projects:
+            with span('plan ' + project.project):
+                plan = project.up_plan()
+            project_tasks, project_dependencies, project_replicas = plan_tasks(self.backend, plan)
+            for name, task in project_tasks.items():
+                key = '{}: {}'.format(project.project, name)
+                tasks[key] = task
+                owners[key] = project
+                dependencies[key] = ['{}: {}'.format(project.project, dependency) for dependency in project_dependencies.get(name, ())]
+            replicas.update(project_replicas)
+            changed.extend(plan_services(plan))
+
+        # the projects share the nodes, they have to fit together
+        check_fit([(project.project_prefix(service), project.service_config(service))
+                   for project in self.projects for service in project.filtered_services],
+                  self.projects[0].cluster_state().nodes, self.require_fit)
+
+        with span('create and update'):
+            results = Executor(self.parallel).run(tasks, dependencies)
+        summary = OrderedDict((project, [0, 0, 0]) for project in self.projects)
+        for key, error in results.items():
+            summary[owners[key]][0 if error is None else 2 if isinstance(error, TaskCancelled) else 1] += 1
 
-                                [k, v] = env.split('=')
-                                container['env'].append(OrderedDict([('name', k), ('value', v)]))
+        try:
+            check_results(results)
+            if replicas:
+                check_results(self.backend.scale_services(replicas, self.parallel))
+        finally:
+            self.print_summary((project, '{} done, {} failed, {} skipped'.format(*counts) if any(counts) else 'up to date')
+                               for project, counts in summary.items())
 
-                def replicas():
-                    deployment_result['spec']['replicas'] = int(value)
+        self.wait_for_convergence(changed)
 
-                def unsupported():
-                    print >> sys.stderr, ('WARNING: unsupported parameter {}'.format(parameter))
+    def pull(self):
+        images = OrderedDict()
+        for project in self.projects:
+            for service in project.filtered_services:
+                images.setdefault(project.service_config(service).image, []).append(project)
+
+        nodes = self.projects[0].cluster_state().nodes
+        targets = pull_targets([project.service_config(service) for project in self.projects for service in project.filtered_services],
+                               nodes)
+        print_pull_matrix(targets, nodes)
+        report = OrderedDict()
+        try:
+            pull_images(self.backend, targets, self.parallel, self.parallel_per_node, report)
+        finally:
+            failed = set(image for (node, image), outcome in report.items() if not outcome or outcome[0] == 'FAILED')
+            self.print_summary((project, '{} of {} images failed'.format(len(failed.intersection(project_images)), len(project_images)))
+                               for project, project_images in
+                               ((project, set(image for image, users in images.items() if project in users)) for project in self.projects))
 
-                locals().get(parameter, unsupported)()
+    def stop(self):
+        services = [(project, service) for project in self.projects for service in project.filtered_services if project.is_service_exists(service)]
+        self.run_batch(services, 'stopped', lambda: self.backend.scale_services(
+            OrderedDict((project.project_prefix(service), 0) for project, service in services), self.parallel))
+        self.wait_for_convergence([project.project_prefix(service) for project, service in services])
+
+    def start(self):
+        services = [(project, service) for project in self.projects for service in project.filtered_services]
+        replicas = OrderedDict()
+        for project, service in services:
+            replicas.update(project.desired_replicas([service]))
+        self.run_batch(services, 'started', lambda: self.backend.scale_services(replicas, self.parallel))
+        self.wait_for_convergence(list(replicas))
 
-            service_selector.update(service_labels)
-            deployment_labels.update(service_labels)
+    def rm(self):
+        services = [(project, service) for project in self.projects for service in project.filtered_services if project.is_service_exists(service)]
+        self.run_batch(services, 'removed', lambda: self.backend.remove_services(
+            [project.project_prefix(service) for project, service in services], self.parallel))
+
+    def run_batch(self, services, done, command):
+        outcome = command() if services else {}
+        counts = OrderedDict((project, [0, 0]) for project in self.projects)
+        for project, service in services:
+            counts[project][outcome[project.project_prefix(service)] is not None] += 1
+        self.print_summary((project, '{} services {}, {} failed'.format(succeeded, done, failed)) for project, (succeeded, failed) in counts.items())
+        check_results(outcome)
+
+    def wait_for_convergence(self, names):
+        if self.wait and not debug and names:
+            wait_for_services(self.backend, names, self.timeout)
 
-            sys.stdout.write(yaml.dump(service_result, default_flow_style=False))
-            print('---')
-            sys.stdout.write(yaml.dump(deployment_result, default_flow_style=False))
-            print('---')
+    @staticmethod
+    def print_summary(rows):
+        print('Projects:')
+        for project, outcome in rows:
+            print('  {:<40} {}'.format(project.project, outcome))
 
 
 def main():
@@ -455,10 +1819,9 @@ def main():
     env_path = os.path.join(os.getcwd(), '.env')
 
     if os.path.isfile(env_path):
-        with open(env_path) as env_file:
-            envs.update(dict(map(lambda line: line.strip().split('=', 1), (line for line in env_file if not line.startswith('#') and line.strip()))))
+        envs.update((k, v) for k, v in read_env_file(env_path) if v is not None)
 
-    map(lambda e: os.environ.update({e[0]: e[1]}), (e for e in envs.items() if not e[0] in os.environ))
+    os.environ.update(dict(e for e in envs.items() if not e[0] in os.environ))
 
     parser = argparse.ArgumentParser(formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=50, width=120))
     parser.add_argument('-f', '--file', type=argparse.FileType(), help='Specify an alternate compose file (default: docker-compose.yml)', default=[],
@@ -466,82 +1829,1010 @@ def main():
     parser.add_argument('-p', '--project-name', help='Specify an alternate project name (default: directory name)',
                         default=os.environ.get('COMPOSE_PROJECT_NAME'))
     parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--cache-dir', default=os.environ.get('COMPOSE_CACHE_DIR'),
+                        help='Reuse the merged compose files from this directory while they are unchanged (default: $COMPOSE_CACHE_DIR)')
+    parser.add_argument('--backend', choices=['auto', 'engine', 'cli'], default='auto',
+                        help='Talk to the Docker Engine API directly or run the docker CLI (default: engine if reachable, cli for --dry-run)')
+    parser.add_argument('--manifest', metavar='FILE',
+                        help='Run the command for every project listed in FILE at once (see README) instead of a single one')
+    parser.add_argument('--profile', action='store_true', help='Time every phase and docker command and print the slowest ones')
+    parser.add_argument('--profile-top', type=int, default=20, metavar='N', help='Number of spans --profile prints (default: 20)')
+    parser.add_argument('--trace', metavar='FILE', help='Write the timings as a Chrome trace (chrome://tracing, Perfetto) to FILE')
+    parser.add_argument('--command-timeout', type=float, metavar='SECONDS',
+                        help='Kill a docker CLI command that runs longer than this (cli backend only, default: no limit)')
     subparsers = parser.add_subparsers(title='Command')
     parser.add_argument('_service', metavar='service', nargs='*', help='List of services to run the command for')
 
     services_parser = argparse.ArgumentParser(add_help=False)
     services_parser.add_argument('service', nargs='*', help='List of services to run the command for')
 
+    wait_parser = argparse.ArgumentParser(add_help=False)
+    wait_parser.add_argument('--wait', action='store_true', help='Wait until the services run the desired number of tasks')
+    wait_parser.add_argument('--timeout', type=float, metavar='SECONDS', help='Give up waiting after SECONDS (default: never)')
+
+    batch_parser = argparse.ArgumentParser(add_help=False)
+    batch_parser.add_argument('--parallel', type=int, default=4, metavar='N',
+                              help='Run up to N commands at once when the services do not fit in one (default: 4)')
+
     pull_parser = subparsers.add_parser('pull', help='Pull service images', add_help=False, parents=[services_parser])
     pull_parser.set_defaults(command='pull')
+    pull_parser.add_argument('--parallel', type=int, default=8, metavar='N', help='Pull up to N images at once in total (default: 8)')
+    pull_parser.add_argument('--parallel-per-node', type=int, default=1, metavar='N', help='Pull up to N images at once on each node (default: 1)')
 
-    rm_parser = subparsers.add_parser('rm', help='Stop and remove services', add_help=False, parents=[services_parser])
+    rm_parser = subparsers.add_parser('rm', help='Stop and remove services', add_help=False, parents=[services_parser, batch_parser])
     rm_parser.set_defaults(command='rm')
     rm_parser.add_argument('-f', help='docker-compose compatibility; ignored', action='store_true')
 
-    start_parser = subparsers.add_parser('start', help='Start services', add_help=False, parents=[services_parser])
+    start_parser = subparsers.add_parser('start', help='Start services', add_help=False, parents=[services_parser, wait_parser, batch_parser])
     start_parser.set_defaults(command='start')
 
-    stop_parser = subparsers.add_parser('stop', help='Stop services', add_help=False, parents=[services_parser])
+    stop_parser = subparsers.add_parser('stop', help='Stop services', add_help=False, parents=[services_parser, wait_parser, batch_parser])
     stop_parser.set_defaults(command='stop')
 
-    up_parser = subparsers.add_parser('up', help='Create and start services', add_help=False, parents=[services_parser])
+    up_parser = subparsers.add_parser('up', help='Create and start services', add_help=False, parents=[services_parser, wait_parser])
     up_parser.set_defaults(command='up')
     up_parser.add_argument('-d', help='docker-compose compatibility; ignored', action='store_true')
+    up_parser.add_argument('--parallel', type=int, default=1, metavar='N', help='Create up to N services concurrently (default: 1)')
+    up_parser.add_argument('--require-fit', action='store_true',
+                           help='Deploy nothing if the memory limits of the services do not fit on the nodes')
+    up_parser.add_argument('--waves', action='store_true',
+                           help='Roll the services out in waves sized to the cluster, each one started once the previous one converged')
+
+    plan_parser = subparsers.add_parser('plan', help='Save what up would do as a plan to review and apply later', add_help=False,
+                                        parents=[services_parser])
+    plan_parser.set_defaults(command='plan')
+    plan_parser.add_argument('--require-fit', action='store_true',
+                             help='Save no plan if the memory limits of the services do not fit on the nodes')
+    plan_parser.add_argument('-o', '--output', default='plan.json', metavar='FILE', help='Write the plan to FILE (default: plan.json)')
+
+    apply_parser = subparsers.add_parser('apply', help='Carry out a saved plan', add_help=False, parents=[wait_parser])
+    apply_parser.set_defaults(command='apply', service=[])
+    apply_parser.add_argument('plan', metavar='PLAN', help='Plan written by the plan command')
+    apply_parser.add_argument('--parallel', type=int, default=1, metavar='N', help='Create up to N services concurrently (default: 1)')
+
+    reconcile_parser = subparsers.add_parser('reconcile', help='Keep services in line with the compose files as the swarm changes',
+                                             add_help=False, parents=[services_parser])
+    reconcile_parser.set_defaults(command='reconcile')
+    reconcile_parser.add_argument('--parallel', type=int, default=1, metavar='N', help='Create up to N services concurrently (default: 1)')
+
+    watch_parser = subparsers.add_parser('watch', help='Bring up services again whenever their configuration changes', add_help=False,
+                                         parents=[services_parser, wait_parser])
+    watch_parser.set_defaults(command='watch')
+    watch_parser.add_argument('--parallel', type=int, default=1, metavar='N', help='Create up to N services concurrently (default: 1)')
+    watch_parser.add_argument('--poll', action='store_true', help='Poll the files every second instead of using inotify')
 
     convert_parser = subparsers.add_parser('convert', help='Convert services to Kubernetes format', add_help=False, parents=[services_parser])
     convert_parser.set_defaults(command='convert')
+    convert_parser.add_argument('--parallel', type=int, metavar='N',
+                                help='Render services in N processes (default: number of CPUs for stacks of {} services '
+                                     'or more, otherwise 1)'.format(CONVERT_POOL_THRESHOLD))
+    convert_parser.add_argument('--output-dir', metavar='DIR',
+                                help='Write one file per service to DIR, rewriting only the changed ones, instead of stdout')
 
     args = parser.parse_args(sys.argv[1:])
 
-    if len(args.file) == 0:
+    if args.manifest and args.command in ('convert', 'plan', 'apply', 'watch', 'reconcile'):
+        parser.error('{} does not support --manifest'.format(args.command))
+    if args.manifest and getattr(args, 'waves', False):
+        parser.error('--waves does not support --manifest')
+    if args.manifest and (args.file or args.service):
+        parser.error('--manifest lists the compose files and services of every project; drop -f and the services')
+
+    if len(args.file) == 0 and not args.manifest and args.command != 'apply':
         try:
-            args.file = map(lambda f: open(f), os.environ['COMPOSE_FILE'].split(':'))
+            args.file = [open(f) for f in os.environ['COMPOSE_FILE'].split(':')]
         except IOError as e:
             print(e)
             parser.print_help()
             sys.exit(1)
 
-    global debug
+    global debug, profiler
     debug = args.dry_run
+    if args.profile or args.trace:
+        profiler = Profiler()
+
+    options = dict(parallel=getattr(args, 'parallel', 1), parallel_per_node=getattr(args, 'parallel_per_node', 1),
+                   wait=getattr(args, 'wait', False), timeout=getattr(args, 'timeout', None))
+    if args.command == 'convert':
+        options['output_dir'] = args.output_dir
+    if args.command == 'plan':
+        options['plan_file'] = args.output
+    if args.command == 'up' and args.waves:
+        options['waves'] = True
+    if args.command in ('up', 'plan'):
+        options['require_fit'] = args.require_fit
+
+    try:
+        backend = docker_backend(args.backend, args.command_timeout)
+
+        if args.command == 'apply':
+            target = SavedPlan(args.plan, backend, **options)
+        elif args.manifest:
+            target = ComposeProjects.from_manifest(args.manifest, args.cache_dir, backend, **options)
+        else:
+            compose_base_dir = os.path.dirname(os.path.abspath(args.file[0].name))
 
-    compose_base_dir = os.path.dirname(os.path.abspath(args.file[0].name))
+            if args.project_name is None:
+                args.project_name = os.path.basename(compose_base_dir)
 
-    if args.project_name is None:
-        args.project_name = os.path.basename(compose_base_dir)
+            if args.command == 'watch':
+                target = ComposeWatch([f.name for f in args.file], args.project_name, compose_base_dir + '/', args.service,
+                                      backend=backend, cache_dir=args.cache_dir, poll=args.poll, **options)
+            else:
+                # Decode and merge the compose files
+                merged_compose = ComposeLoader(compose_base_dir + '/', args.cache_dir).load([f.name for f in args.file])
+
+                target = DockerCompose(merged_compose, args.project_name, compose_base_dir + '/', args.service, backend=backend, **options)
+
+        with span(args.command):
+            getattr(target, args.command)()
+    except ComposeError as e:
+        print('ERROR: {}'.format(e), file=sys.stderr)
+        sys.exit(getattr(e, 'returncode', 1))
+    finally:
+        if profiler is not None and args.profile:
+            profiler.print_summary(args.profile_top)
+        if profiler is not None and args.trace:
+            profiler.write_trace(args.trace)
+
+
+def merge_configs(configs, first_wins=False, rules=None, default=None):
+    """Merges mappings in a single pass over all of them, later ones taking precedence (earlier ones with first_wins).
+
+    rules maps keys to the functions merging the values the mappings have for them, default (merge_values) is used
+    for other keys. Keys keep the order they are first seen in. configs are left unchanged, but values only one of
+    them has are taken as they are rather than copied.
+    """
+    keys = []
+    values = {}
+    for config in configs:
+        for key, value in config.items():
+            if key in values:
+                values[key].append(value)
+            else:
+                keys.append(key)
+                values[key] = [value]
+    rules = rules or {}
+    default = default or merge_values
+    result = OrderedDict()
+    for key in keys:
+        key_values = values[key]
+        rule = rules.get(key, default)
+        if len(key_values) == 1 and rule in (merge_values, replace_value):
+            result[key] = key_values[0]
+        else:
+            result[key] = rule(key_values, first_wins)
+    return result
 
-    # Decode and merge the compose files
-    compose_dicts = map(lambda f: yaml.load(f, yodl.OrderedDictYAMLLoader), args.file)
-    merged_compose = reduce(merge, compose_dicts)
 
-    docker_compose = DockerCompose(merged_compose, args.project_name, compose_base_dir + '/', args.service)
-    getattr(docker_compose, args.command)()
+def merge_values(values, first_wins=False):
+    """Merges mappings recursively and joins lists without duplicates; any other value is replaced."""
+    if len(values) == 1:
+        return values[0]
+    if all(isinstance(value, dict) for value in values):
+        return merge_configs(values, first_wins)
+    if all(isinstance(value, list) for value in values):
+        try:
+            return list(OrderedDict.fromkeys(chain.from_iterable(values)))
+        except TypeError:  # mappings cannot be hashed
+            result = []
+            for item in chain.from_iterable(values):
+                if item not in result:
+                    result.append(item)
+            return result
+    return replace_value(values, first_wins)
+
+
+def replace_value(values, first_wins=False):
+    return values[0 if first_wins else -1]
+
+
+def merge_keyed(values, first_wins=False, names=None):
+    """Merges lists of entries, or mappings, by the names names() gives the entries of a list (the keys of a mapping).
+
+    Entries keep the position their name is first seen at. The result is a mapping if all the values are, a list
+    with mapping items written as `name=value` otherwise.
+    """
+    as_mapping = all(isinstance(value, dict) for value in values)
+    if len(values) == 1 and (as_mapping or isinstance(values[0], list)):
+        return values[0]
+    if not as_mapping:
+        values = [[name if entry is None else '{}={}'.format(name, entry) for name, entry in value.items()]
+                  if isinstance(value, dict) else value or [] for value in values]
+    if first_wins:
+        merged = OrderedDict()
+        for value in values:
+            entries = value.items() if as_mapping else zip(names(value), value)
+            merged.update([(name, entry) for name, entry in OrderedDict(entries).items() if name not in merged])
+        return merged if as_mapping else list(merged.values())
+    if as_mapping:
+        merged = OrderedDict(values[0])
+        for value in values[1:]:
+            merged.update(value)
+        return merged
+    entries = list(chain.from_iterable(values))
+    entry_names = names(entries)
+    # most of the time no entry is overridden, and the joined lists are the result
+    if len(set(entry_names)) < len(entry_names):
+        return list(OrderedDict(zip(entry_names, entries)).values())
+    return entries
+
+
+def variable_names(entries):
+    names = label_names(entries)
+    # constraints share the environment list, and a service can have several of them on the same attribute
+    if 'constraint:' in ' '.join(names):
+        return [entry if name.startswith('constraint:') else name for name, entry in zip(names, entries)]
+    return names
+
+
+def label_names(entries):
+    try:
+        return [entry.partition('=')[0] for entry in entries]
+    except AttributeError:
+        return [str(entry).partition('=')[0] for entry in entries]
+
+
+def mount_targets(entries):
+    targets = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            targets.append(entry.get('target'))
+        else:
+            parts = str(entry).split(':')
+            targets.append(parts[1] if len(parts) > 1 else parts[0])
+    return targets
+
+
+def merge_service_configs(values, first_wins=False):
+    # `web:` with no keys in an override file is a null service
+    return merge_configs([value or {} for value in values], first_wins, SERVICE_MERGE_RULES)
+
+
+# how docker-compose merges the keys of a service defined in several files or extending another one
+SERVICE_MERGE_RULES = {
+    'image': replace_value,
+    'command': replace_value,
+    'entrypoint': replace_value,
+    'environment': partial(merge_keyed, names=variable_names),
+    'labels': partial(merge_keyed, names=label_names),
+    'volumes': partial(merge_keyed, names=mount_targets),
+    'devices': partial(merge_keyed, names=mount_targets),
+}
+COMPOSE_MERGE_RULES = {'services': partial(merge_configs, default=merge_service_configs)}
+
+
+def plan_tasks(backend, plan):
+    """Returns the tasks carrying out the actions of a plan, their dependencies, and the replicas of the services to scale."""
+    tasks = OrderedDict()
+    dependencies = {}
+    replicas = OrderedDict()
+
+    for action in plan['actions']:
+        name, target = action['name'], action['target']
+        if action['action'] == 'create network':
+            tasks[name] = partial(backend.create_network, target)
+        elif action['action'] == 'create volume':
+            tasks[name] = partial(backend.create_volume, target, action.get('driver'))
+        elif action['action'] == 'create service':
+            tasks[name] = partial(backend.create_service, target, action['flags'], action['image'], action['command'])
+        elif action['action'] == 'update service':
+            tasks[name] = partial(backend.update_service, target, action['flags'], action['image'], action['command'], action['current'])
+        elif action['action'] == 'scale service':
+            replicas[target] = action['replicas']
+        dependencies[name] = action.get('depends_on', [])
+
+    return tasks, dependencies, replicas
+
+
+def cluster_capacity(nodes):
+    """Returns how many tasks the nodes taking new ones can start at once (one per CPU) and their memory in bytes."""
+    nodes = [node for node in nodes if node.get('Spec', {}).get('Availability', 'active') == 'active']
+    resources = [node.get('Description', {}).get('Resources') or {} for node in nodes]
+    return sum(max(1, r.get('NanoCPUs', 0) // 10 ** 9) for r in resources), sum(r.get('MemoryBytes', 0) for r in resources)
+
+
+def rollout_waves(plan, configs, nodes):
+    """Splits a plan into plans starting no more tasks than the nodes have CPUs and asking for no more memory than they have.
+
+    configs maps the services of the plan to their ServiceConfigs. Services go in the order of their `x-rollout` wave
+    and their dependencies, a service too big for any wave gets one of its own; without nodes to size them (as with
+    --dry-run) the waves are just the `x-rollout` ones. Services without an update parallelism
+    of their own update as many tasks at once as there are nodes they can run on.
+    """
+    cpus, memory = cluster_capacity(nodes)
+    active = [node for node in nodes if node.get('Spec', {}).get('Availability', 'active') == 'active']
+    actions = OrderedDict((action['name'], action) for action in plan['actions'] if action['action'].endswith(' service'))
+    check_acyclic(dict((name, action.get('depends_on', ())) for name, action in actions.items()))
+
+    ordered = []
+    seen = set()
+
+    def visit(name):
+        if name in seen or name not in actions:
+            return
+        seen.add(name)
+        for dependency in actions[name].get('depends_on', ()):
+            visit(dependency)
+        ordered.append(name)
+
+    for name in actions:
+        visit(name)
+    ordered.sort(key=lambda name: configs[actions[name]['target']].wave)
+
+    waves = []
+    used = None
+    for name in ordered:
+        action, config = actions[name], configs[actions[name]['target']]
+        for dependency in action.get('depends_on', ()):
+            if dependency in actions and configs[actions[dependency]['target']].wave > config.wave:
+                raise ComposeError('{} (x-rollout wave {}) depends on {} of a later wave'.format(name, config.wave, dependency))
+
+        eligible = len([node for node in active if node_matches(node, config.constraints)])
+        tasks = eligible if config.mode == 'global' else config.desired_replicas()
+        task_memory = parse_bytes(config.mem_limit) * tasks if config.mem_limit is not None else 0
+        if used is None or used[0] != config.wave or (cpus and used[1] + tasks > cpus) or (memory and used[2] + task_memory > memory):
+            waves.append([])
+            used = [config.wave, 0, 0]
+        used[1] += tasks
+        used[2] += task_memory
+
+        if 'flags' in action and config.update_parallelism is None:
+            action = OrderedDict(action, flags=action['flags'] + [('--update-parallelism', max(1, min(tasks, eligible)))])
+        waves[-1].append(action)
+
+    infrastructure = [action for action in plan['actions'] if action['action'] in ('create network', 'create volume')]
+    if infrastructure:
+        waves[:1] = [infrastructure + (waves[0] if waves else [])]
+    return [OrderedDict(plan, actions=wave) for wave in waves]
+
+
+def fit_services(services, nodes):
+    """Places the tasks of the services, (name, ServiceConfig) pairs, on the nodes taking new tasks, each task reserving
+    its `mem_limit`, and returns (name, tasks, tasks left over, memory of a task, hostnames it can run on) for the
+    services that do not fit.
+
+    Global services get a task on every node they can run on; the other tasks go, biggest first, to the node with the
+    most memory left, as the scheduler spreads them. Nodes that do not report their memory take anything.
+    """
+    nodes = [node for node in nodes if node.get('Spec', {}).get('Availability', 'active') == 'active']
+    free = [(node.get('Description', {}).get('Resources') or {}).get('MemoryBytes') or float('inf') for node in nodes]
+    eligible_nodes = {}
+    heaps = {}
+    misfits = []
+    replicated = []
+
+    for name, config in services:
+        constraints = tuple(config.constraints)
+        if constraints not in eligible_nodes:
+            eligible_nodes[constraints] = [index for index, node in enumerate(nodes) if node_matches(node, constraints)]
+        eligible = eligible_nodes[constraints]
+        memory = parse_bytes(config.mem_limit) if config.mem_limit is not None else 0
+
+        if config.mode == 'global':
+            left = 0
+            for index in eligible:
+                if free[index] < memory:
+                    left += 1
+                else:
+                    free[index] -= memory
+            if left:
+                misfits.append((name, len(eligible), left, memory, eligible))
+        else:
+            replicated.append((memory, name, constraints, config.desired_replicas()))
+
+    for memory, name, constraints, tasks in sorted(replicated, key=lambda service: -service[0]):
+        eligible = eligible_nodes[constraints]
+        if not tasks or (not memory and eligible):
+            continue
+        # one heap of (-memory left, node) per set of eligible nodes; entries other services made stale are fixed when popped
+        heap = heaps.get(constraints)
+        if heap is None:
+            heap = heaps[constraints] = [(-free[index], index) for index in eligible]
+            heapq.heapify(heap)
+        placed = 0
+        while placed < tasks and heap:
+            left, index = heap[0]
+            if -left != free[index]:
+                heapq.heapreplace(heap, (-free[index], index))
+            elif free[index] < memory:
+                break
+            else:
+                free[index] -= memory
+                heapq.heapreplace(heap, (-free[index], index))
+                placed += 1
+        if placed < tasks:
+            misfits.append((name, tasks, tasks - placed, memory, eligible))
+
+    return [(name, tasks, left, memory, [nodes[index]['Description']['Hostname'] for index in eligible])
+            for name, tasks, left, memory, eligible in misfits]
+
+
+def check_fit(services, nodes, required=False):
+    """Lists the services whose memory limits do not fit on the nodes, and fails if required.
+
+    The swarm scheduler only places tasks by the memory they reserve, limits that overcommit the nodes still deploy,
+    which is why not enough memory is just a warning by default; no node matching the constraints of a service always
+    fails, its tasks would stay pending.
+    """
+    if not nodes:
+        # nothing to check against, as with --dry-run
+        return
+    with span('fit check'):
+        misfits = fit_services(services, nodes)
+    if not misfits:
+        return
+
+    print('Services not fitting on the nodes:', file=sys.stderr)
+    for name, tasks, left, memory, hostnames in misfits:
+        if not hostnames:
+            reason = 'no node taking tasks matches its constraints'
+        else:
+            reason = 'not enough memory for {} MiB tasks on {}'.format(memory // 1048576, ', '.join(hostnames))
+        print('  {:<60} {} of {} tasks: {}'.format(name, left, tasks, reason), file=sys.stderr)
+    message = '{} of {} services do not fit on the nodes'.format(len(misfits), len(services))
+    if required or not all(hostnames for _, _, _, _, hostnames in misfits):
+        raise ComposeError(message)
+    print('WARNING: {}; their tasks may run out of memory (--require-fit makes this an error)'.format(message), file=sys.stderr)
+
+
+def plan_services(plan):
+    """Returns the names of the services a plan changes."""
+    return [action['target'] for action in plan['actions'] if action['action'].endswith(' service')]
+
+
+def apply_plan(backend, plan, workers=1):
+    if plan.get('version') != PLAN_VERSION:
+        raise ComposeError('unsupported plan version {}, expected {}'.format(plan.get('version'), PLAN_VERSION))
+    # lets the CLI backend tell the networks of the current specs by name
+    getattr(backend, 'network_ids', {}).update(plan['networks'])
+
+    tasks, dependencies, replicas = plan_tasks(backend, plan)
+    with span('create and update'):
+        check_results(Executor(workers).run(tasks, dependencies))
+    if replicas:
+        with span('scale'):
+            check_results(backend.scale_services(replicas, workers))
+
+
+def print_plan(plan, file=sys.stderr):
+    print('Plan for project {}:'.format(plan['project']), file=file)
+    for action in plan['actions']:
+        details = ''
+        if action['action'] == 'update service':
+            changes = service_update_flags(service_spec(action['target'], action['flags'], action['image'], action['command']),
+                                           action['current'].get('Spec', {}), partial(network_name, plan['networks']))
+            details = ' ({})'.format(', '.join(OrderedDict.fromkeys(flag for flag, _ in changes)))
+        elif action['action'] == 'scale service':
+            details = ' to {}'.format(action['replicas'])
+        print('  {:<16} {}{}'.format(action['action'], action['target'], details), file=file)
+
+
+def retry(call, attempts=4, delay=0.5):
+    """Calls call, retrying with exponential backoff as long as it fails with a transient error."""
+    for attempt in range(attempts):
+        try:
+            return call()
+        except ComposeError as e:
+            if attempt == attempts - 1 or not TRANSIENT_ERRORS.search(str(e)):
+                raise
+            print('WARNING: {}; retrying in {}s'.format(e, delay * 2 ** attempt), file=sys.stderr)
+            time.sleep(delay * 2 ** attempt)
 
 
-# Based on http://stackoverflow.com/questions/7204805/dictionaries-of-dictionaries-merge/7205107#7205107
-def merge(a, b, path=None, conflict_resolver=None):
-    """merges b into a"""
-    if path is None:
-        path = []
-    for key in b:
-        if key in a:
-            if isinstance(a[key], dict) and isinstance(b[key], dict):
-                merge(a[key], b[key], path + [str(key)], conflict_resolver)
-            elif isinstance(a[key], list) and isinstance(b[key], list):
-                a[key].extend(b[key])
-            elif a[key] == b[key]:
-                pass  # same leaf value
-            else:
-                if conflict_resolver:
-                    conflict_resolver(a, b, key)
-                else:
-                    raise Exception('Conflict at %s' % '.'.join(path + [str(key)]))
+def run_batches(batches, run, workers=1):
+    """Calls run(batch) for every batch of service names on up to workers threads, retrying transient failures.
+
+    A batch that still fails is rerun service by service to tell which of them failed. Returns an OrderedDict of
+    service name -> None or the exception it failed with.
+    """
+    outcome = OrderedDict((name, None) for batch in batches for name in batch)
+
+    def run_batch(batch):
+        try:
+            retry(partial(run, batch))
+        except ComposeError as e:
+            if len(batch) == 1:
+                outcome[batch[0]] = e
+                return
+            for name in batch:
+                try:
+                    retry(partial(run, [name]))
+                except ComposeError as e:
+                    outcome[name] = e
+
+    Executor(workers).run(OrderedDict((index, partial(run_batch, batch)) for index, batch in enumerate(batches)))
+    return outcome
+
+
+def check_results(results):
+    failed = [(name, error) for name, error in results.items() if error is not None]
+    for name, error in failed:
+        print('ERROR: {}: {}'.format(name, error), file=sys.stderr)
+    if failed:
+        raise ComposeError('{} of {} operations failed'.format(len(failed), len(results)))
+
+
+def pull_images(backend, targets, workers, parallel_per_node, report=None):
+    """Pulls every image on the nodes targets lists for it, skipping the nodes having it with the digest the registry has.
+
+    The outcome of every pull is recorded in report as (node, image) -> (status, seconds), None for cancelled ones.
+    """
+    nodes = list(OrderedDict.fromkeys(node for image_nodes in targets.values() for node in image_nodes))
+    digests = {}
+    node_slots = dict((node, threading.Semaphore(parallel_per_node)) for node in nodes)
+    report = report if report is not None else OrderedDict()
+    report.update(((node, image), None) for image, image_nodes in targets.items() for node in image_nodes)
+
+    def resolve(image):
+        digests[image] = backend.image_digest(image)
+
+    def pull_on(node, image):
+        with node_slots[node]:
+            started = time.time()
+            try:
+                if digests[image] and digests[image] in backend.node_image_digests(node, image):
+                    report[node, image] = ('up to date', time.time() - started)
+                    return
+                echo('Pulling {} on node {}'.format(image, node))
+                backend.pull_image(node, image)
+                report[node, image] = ('pulled', time.time() - started)
+            except Exception:
+                report[node, image] = ('FAILED', time.time() - started)
+                raise
+
+    tasks = OrderedDict(('image ' + image, partial(resolve, image)) for image, image_nodes in targets.items() if image_nodes)
+    dependencies = {}
+    # image by image across all the nodes, so that a registry serves the same layers to every node at about the same time
+    for image, image_nodes in targets.items():
+        for node in image_nodes:
+            tasks['pull {} on node {}'.format(image, node)] = partial(pull_on, node, image)
+            dependencies['pull {} on node {}'.format(image, node)] = ['image ' + image]
+
+    try:
+        with span('pull'):
+            check_results(Executor(workers).run(tasks, dependencies))
+    finally:
+        for node in nodes:
+            print('Node {}:'.format(node))
+            for image, image_nodes in targets.items():
+                if node in image_nodes:
+                    status, duration = report[node, image] or ('cancelled', 0)
+                    print('  {:<60} {:<10} {:.1f}s'.format(image, status, duration))
+
+
+def pull_targets(configs, nodes):
+    """Returns image -> hostnames of the nodes where some of the services (ServiceConfigs) using it can run."""
+    targets = OrderedDict()
+    for config in configs:
+        eligible = targets.setdefault(config.image, OrderedDict())
+        for node in nodes:
+            # drained nodes run no tasks at all
+            if node.get('Spec', {}).get('Availability') != 'drain' and node_matches(node, config.constraints):
+                eligible[node['Description']['Hostname']] = True
+    return OrderedDict((image, [node['Description']['Hostname'] for node in nodes if node['Description']['Hostname'] in eligible])
+                       for image, eligible in targets.items())
+
+
+def print_pull_matrix(targets, nodes):
+    hostnames = [node['Description']['Hostname'] for node in nodes]
+    width = max([len('image')] + [len(image) for image in targets])
+    print('Pull matrix:')
+    print('  {:<{}}  {}'.format('image', width, '  '.join(hostnames)))
+    for image, image_nodes in targets.items():
+        print('  {:<{}}  {}'.format(image, width, '  '.join('{:^{}}'.format('x' if hostname in image_nodes else '-', len(hostname))
+                                                              for hostname in hostnames)))
+
+
+def node_matches(node, constraints):
+    """Tells whether a node (as returned by the engine) satisfies placement constraints such as `node.labels.gpu==true`.
+
+    Values are compared case-insensitively as the swarm does; constraints on attributes that are not known here are
+    assumed to be satisfied, so that no node the service might run on is left out.
+    """
+    for constraint in constraints:
+        match = re.match(r'^\s*([\w.\-/]+)\s*(==|!=)\s*(.*?)\s*$', constraint)
+        if not match:
+            continue
+        key, operator, expected = match.groups()
+        actual = node_attribute(node, key)
+        if actual is NotImplemented:
+            continue
+        if ((actual or '').lower() == expected.lower()) != (operator == '=='):
+            return False
+    return True
+
+
+def node_attribute(node, key):
+    """Returns the value of a constraint attribute for a node, None when it is not set, NotImplemented for unknown ones."""
+    description = node.get('Description', {})
+    if key.startswith('node.labels.'):
+        return (node.get('Spec', {}).get('Labels') or {}).get(key[len('node.labels.'):])
+    if key.startswith('engine.labels.'):
+        return (description.get('Engine', {}).get('Labels') or {}).get(key[len('engine.labels.'):])
+    attributes = {
+        'node.id': node.get('ID'),
+        'node.hostname': description.get('Hostname'),
+        'node.role': node.get('Spec', {}).get('Role'),
+        'node.platform.os': description.get('Platform', {}).get('OS'),
+        'node.platform.arch': description.get('Platform', {}).get('Architecture'),
+    }
+    return attributes.get(key, NotImplemented)
+
+
+def wait_for_services(backend, names, timeout=None, poll_interval=1):
+    """Polls until every service runs as many tasks as it should, then reports how long each one took to converge."""
+    started = time.time()
+    converged = OrderedDict()
+
+    with span('wait for convergence'):
+        while True:
+            status = backend.service_status(names)
+            for name in names:
+                running, desired, updating = status.get(name, (None, None, True))
+                if name not in converged and running == desired and not updating:
+                    converged[name] = time.time() - started
+
+            pending = [name for name in names if name not in converged]
+            if not pending or (timeout and time.time() - started > timeout):
+                break
+            time.sleep(poll_interval)
+
+    print('Convergence:')
+    for name in names:
+        if name in converged:
+            print('  {:<60} {:.1f}s'.format(name, converged[name]))
         else:
-            a[key] = b[key]
-    return a
+            running, desired, _ = status.get(name, ('?', '?', False))
+            print('  {:<60} not converged ({}/{} tasks running)'.format(name, running, desired))
+
+    if pending:
+        raise ComposeError('{} of {} services did not converge within {}s'.format(len(pending), len(names), timeout))
+
+
+def is_updating(service):
+    """Tells whether a service (as returned by the engine) is being updated or rolled back."""
+    return (service.get('UpdateStatus') or {}).get('State') in ('updating', 'rollback_started')
+
+
+def service_spec(name, flags, image, command):
+    """Translates `docker service create` flags into an Engine API ServiceSpec."""
+    container_spec = {'Image': image, 'Env': [], 'Mounts': []}
+    task_template = {'ContainerSpec': container_spec, 'Placement': {'Constraints': []}}
+    spec = {'Name': name, 'Labels': {}, 'TaskTemplate': task_template, 'Mode': {'Replicated': {'Replicas': 1}}, 'Networks': []}
+    ports = []
+
+    if command:
+        container_spec['Args'] = command
+
+    for key, value in flags:
+        value = str(value)
+        if key == '--restart-condition':
+            task_template['RestartPolicy'] = {'Condition': value}
+        elif key == '--log-driver':
+            task_template.setdefault('LogDriver', {'Options': {}})['Name'] = value
+        elif key == '--log-opt':
+            k, v = value.split('=', 1)
+            task_template.setdefault('LogDriver', {'Options': {}})['Options'][k] = v
+        elif key == '--limit-memory':
+            task_template['Resources'] = {'Limits': {'MemoryBytes': parse_bytes(value)}}
+        elif key == '--label':
+            k, _, v = value.partition('=')
+            spec['Labels'][k] = v
+        elif key == '--mode':
+            spec['Mode'] = {'Global': {}} if value == 'global' else {'Replicated': {'Replicas': 1}}
+        elif key == '--replicas':
+            spec['Mode'] = {'Replicated': {'Replicas': int(value)}}
+        elif key == '--publish':
+            port, _, protocol = value.partition('/')
+            published, _, target = port.rpartition(':')
+            ports.append(dict({'Protocol': protocol or 'tcp', 'TargetPort': int(target)},
+                              **({'PublishedPort': int(published)} if published else {})))
+        elif key == '--network':
+            spec['Networks'].append({'Target': value})
+        elif key == '--mount':
+            options = dict(option.split('=', 1) for option in value.split(','))
+            container_spec['Mounts'].append({
+                'Type': options.get('type', 'volume'),
+                'Source': options['src'],
+                'Target': options['dst'],
+                'ReadOnly': options.get('readonly') in ('1', 'true'),
+            })
+        elif key == '--env':
+            container_spec['Env'].append(value)
+        elif key == '--env-file':
+            container_spec['Env'].extend('{}={}'.format(k, os.environ[k] if v is None else v) for k, v in read_env_file(value)
+                                         if v is not None or k in os.environ)
+        elif key == '--constraint':
+            task_template['Placement']['Constraints'].append(value)
+        elif key == '--update-parallelism':
+            spec.setdefault('UpdateConfig', {})['Parallelism'] = int(value)
+        elif key == '--update-delay':
+            spec.setdefault('UpdateConfig', {})['Delay'] = parse_duration(value)
+        else:
+            raise ComposeError('flag {} is not supported by the engine backend'.format(key))
+
+    if ports:
+        spec['EndpointSpec'] = {'Ports': ports}
+    # the last value of a variable wins, as with the CLI
+    container_spec['Env'] = list(OrderedDict((env.split('=', 1)[0], env) for env in container_spec['Env']).values())
+    return spec
+
+
+def network_name(network_ids, target):
+    """Returns the name of the network target is the name or (possibly truncated) id of."""
+    for network, network_id in network_ids.items():
+        if target == network or (network_id and target.startswith(network_id)):
+            return network
+    return target
+
+
+def service_update_flags(spec, current, network_name=lambda target: target):
+    """Returns the `docker service update` flags turning the current ServiceSpec into the desired one."""
+    flags = []
+    task_template, current_task_template = spec['TaskTemplate'], current.get('TaskTemplate', {})
+    container_spec, current_container_spec = task_template['ContainerSpec'], current_task_template.get('ContainerSpec', {})
+
+    if ('Global' in spec['Mode']) != ('Global' in current.get('Mode', {})):
+        raise ComposeError('mode of service "{}" cannot be changed, remove the service first'.format(spec['Name']))
+
+    def update_list(flag, desired, current_items, key=lambda item: item, remove_value=None):
+        desired = OrderedDict((key(item), item) for item in desired)
+        current_items = OrderedDict((key(item), item) for item in current_items)
+        for k, item in current_items.items():
+            if k not in desired:
+                flags.append((flag + '-rm', remove_value(item) if remove_value else k))
+        for k, item in desired.items():
+            if current_items.get(k) != item:
+                flags.append((flag + '-add', item))
+
+    # the swarm pins the image to the digest it resolved, which only counts if the desired image has one too
+    current_image = current_container_spec.get('Image', '')
+    if '@' not in container_spec['Image']:
+        current_image = current_image.split('@')[0]
+    if split_image(container_spec['Image']) != split_image(current_image):
+        flags.append(('--image', container_spec['Image']))
+    if container_spec.get('Args', []) != (current_container_spec.get('Args') or []):
+        flags.append(('--args', ' '.join(shellquote(arg) for arg in container_spec.get('Args', []))))
+
+    update_list('--env', container_spec['Env'], current_container_spec.get('Env') or [], key=lambda env: env.split('=', 1)[0])
+    update_list('--constraint', task_template['Placement']['Constraints'],
+                current_task_template.get('Placement', {}).get('Constraints') or [])
+
+    def mount_flag(mount):
+        return 'type={},src={},dst={},readonly={}'.format(mount['Type'], mount['Source'], mount['Target'], int(mount['ReadOnly']))
+
+    current_mounts = [dict(mount, ReadOnly=mount.get('ReadOnly', False)) for mount in current_container_spec.get('Mounts') or []]
+    update_list('--mount', [mount_flag(mount) for mount in container_spec['Mounts']], [mount_flag(mount) for mount in current_mounts],
+                key=lambda mount: mount.split(',dst=')[1].split(',')[0])
+
+    def port_flag(port):
+        published = '{}:'.format(port['PublishedPort']) if port.get('PublishedPort') else ''
+        return '{}{}/{}'.format(published, port['TargetPort'], port.get('Protocol', 'tcp'))
+
+    current_ports = (current.get('EndpointSpec') or {}).get('Ports') or []
+    update_list('--publish', [port_flag(port) for port in spec.get('EndpointSpec', {}).get('Ports', [])],
+                [port_flag(port) for port in current_ports], key=lambda port: port.split(':')[-1],
+                remove_value=lambda port: port.split(':')[-1].split('/')[0])
+
+    current_networks = current_task_template.get('Networks') or current.get('Networks') or []
+    update_list('--network', [network['Target'] for network in spec['Networks']],
+                [network_name(network['Target']) for network in current_networks])
+
+    current_labels = current.get('Labels') or {}
+    for k in current_labels:
+        if k not in spec['Labels']:
+            flags.append(('--label-rm', k))
+    for k, v in spec['Labels'].items():
+        if current_labels.get(k) != v:
+            flags.append(('--label-add', '{}={}'.format(k, v)))
+
+    replicas = spec['Mode'].get('Replicated', {}).get('Replicas')
+    if replicas is not None and replicas != current.get('Mode', {}).get('Replicated', {}).get('Replicas'):
+        flags.append(('--replicas', replicas))
+
+    memory = task_template.get('Resources', {}).get('Limits', {}).get('MemoryBytes', 0)
+    if memory != (current_task_template.get('Resources') or {}).get('Limits', {}).get('MemoryBytes', 0):
+        flags.append(('--limit-memory', '{}b'.format(memory)))
+
+    condition = task_template.get('RestartPolicy', {}).get('Condition', 'any')
+    if condition != (current_task_template.get('RestartPolicy') or {}).get('Condition', 'any'):
+        flags.append(('--restart-condition', condition))
+
+    # the defaults of the swarm: one task at a time, without delay
+    update_config, current_update_config = spec.get('UpdateConfig', {}), current.get('UpdateConfig') or {}
+    parallelism = update_config.get('Parallelism', 1)
+    if parallelism != current_update_config.get('Parallelism', 1):
+        flags.append(('--update-parallelism', parallelism))
+    delay = update_config.get('Delay', 0)
+    if delay != current_update_config.get('Delay', 0):
+        flags.append(('--update-delay', '{}ns'.format(delay)))
+
+    log_driver = task_template.get('LogDriver')
+    if log_driver and log_driver != current_task_template.get('LogDriver'):
+        flags.append(('--log-driver', log_driver['Name']))
+        flags.extend(('--log-opt', '{}={}'.format(k, v)) for k, v in log_driver['Options'].items())
+
+    return flags
+
+
+def parse_bytes(value):
+    units = {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([bkmgt]?)b?\s*$', str(value).lower())
+    if not match:
+        raise ComposeError('invalid size: "{}"'.format(value))
+    return int(float(match.group(1)) * units[match.group(2) or 'b'])
+
+
+def parse_duration(value):
+    """Returns the nanoseconds of a duration such as `10s`, `1m30s`, or `500ms`; a bare number is in seconds."""
+    units = {'ns': 1, 'us': 10 ** 3, 'ms': 10 ** 6, 's': 10 ** 9, 'm': 60 * 10 ** 9, 'h': 3600 * 10 ** 9}
+    value = str(value).strip()
+    if re.match(r'^\d+(?:\.\d+)?$', value):
+        return int(float(value) * units['s'])
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ns|us|ms|s|m|h)', value)
+    if not parts or ''.join(number + unit for number, unit in parts) != value:
+        raise ComposeError('invalid duration: "{}"'.format(value))
+    return int(sum(float(number) * units[unit] for number, unit in parts))
+
+
+def split_image(image):
+    """Splits an image reference into the repository and the tag (or digest) parts."""
+    if '@' in image:
+        return image.split('@', 1)
+    repository, _, tag = image.rpartition(':')
+    if not repository or '/' in tag:
+        return image, 'latest'
+    return repository, tag
+
+
+def image_registry(image):
+    parts = image.split('/', 1)
+    if len(parts) == 2 and ('.' in parts[0] or ':' in parts[0] or parts[0] == 'localhost'):
+        return 'index.docker.io' if parts[0] == 'docker.io' else parts[0]
+    return 'index.docker.io'
+
+
+def registry_auth(image):
+    """Encodes the credentials stored by `docker login` for the image's registry, like `--with-registry-auth` does.
+
+    As with the docker CLI, a credential helper (`credHelpers` for the registry, or `credsStore`) takes precedence over
+    the credentials stored in the config file itself.
+    """
+    config_path = os.path.join(os.environ.get('DOCKER_CONFIG', os.path.expanduser('~/.docker')), 'config.json')
+    try:
+        with open(config_path) as config_file:
+            config = json.load(config_file)
+    except (IOError, ValueError):
+        return None
+
+    registry = image_registry(image)
+    addresses = [address for address in config.get('auths') or {} if address.split('://')[-1].split('/')[0] == registry]
+    helper = (config.get('credHelpers') or {}).get(registry) or config.get('credsStore')
+    auth = None
+    if helper:
+        # Docker Hub logins are stored under the URL of its v1 API
+        address = addresses[0] if addresses else 'https://index.docker.io/v1/' if registry == 'index.docker.io' else registry
+        if (helper, address) not in helper_credentials_cache:
+            helper_credentials_cache[(helper, address)] = helper_credentials(helper, address, image)
+        auth = helper_credentials_cache[(helper, address)]
+    else:
+        for address in addresses:
+            if config['auths'][address].get('auth'):
+                username, _, password = base64.b64decode(config['auths'][address]['auth']).decode('utf-8').partition(':')
+                auth = {'username': username, 'password': password, 'serveraddress': address}
+                break
+    return base64.urlsafe_b64encode(json.dumps(auth).encode('utf-8')).decode('ascii') if auth else None
+
+
+def helper_credentials(helper, address, image):
+    """Returns the credentials `docker-credential-<helper> get` has for a registry, None (with a warning) if it has none."""
+    try:
+        ps = subprocess.Popen(['docker-credential-' + helper, 'get'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+        output = ps.communicate(address.encode('utf-8'))[0].decode('utf-8')
+        if ps.returncode != 0:
+            raise ComposeError(output.strip())
+        credentials = json.loads(output)
+    except (OSError, ValueError, ComposeError) as e:
+        print('WARNING: no credentials from docker-credential-{} for {}, the nodes may fail to pull {}: {}'.format(
+            helper, address, image, e), file=sys.stderr)
+        return None
+    # an identity token is stored with <token> as the user name
+    if credentials.get('Username') == '<token>':
+        return {'identitytoken': credentials.get('Secret'), 'serveraddress': address}
+    return {'username': credentials.get('Username'), 'password': credentials.get('Secret'), 'serveraddress': address}
+
+
+def check_acyclic(dependencies):
+    visited = set()
+
+    def visit(name, path):
+        if name in path:
+            cycle = path[path.index(name):] + [name]
+            raise ComposeError('dependency cycle: {}'.format(' -> '.join(cycle)))
+        if name in visited:
+            return
+        for dependency in dependencies.get(name, ()):
+            visit(dependency, path + [name])
+        visited.add(name)
+
+    for name in dependencies:
+        visit(name, [])
+
+
+env_files = {}
+env_files_lock = threading.Lock()
+
+
+def read_env_file(path):
+    """Returns the (name, value) pairs of an env file, which is parsed once per run; value is None for a bare name."""
+    with env_files_lock:
+        if path not in env_files:
+            variables = []
+            try:
+                with open(path) as env_file:
+                    for line in env_file:
+                        line = line.strip()
+                        if line and not line.startswith('#'):
+                            k, separator, v = line.partition('=')
+                            variables.append((k, v if separator else None))
+            except (IOError, OSError) as e:
+                raise ComposeError('cannot read env file: {}'.format(e))
+            env_files[path] = variables
+        return env_files[path]
+
+
+def env_file_digest(path):
+    """Returns a digest of the variables of an env file, with the values bare names take from the environment."""
+    variables = [(k, os.environ.get(k) if v is None else v) for k, v in read_env_file(path)]
+    return hashlib.sha256(json.dumps(variables).encode('utf-8')).hexdigest()
+
+
+INTERPOLATION = re.compile(r'\$(?:(\$)|\{([A-Za-z_][A-Za-z0-9_]*)(?:(:?-)([^}]*))?\}|([A-Za-z_][A-Za-z0-9_]*))')
+
+
+def interpolate(value, used):
+    """Substitutes $VAR, ${VAR}, ${VAR-default} and ${VAR:-default} in all the strings of value; $$ is a literal $.
+
+    The variables referenced are recorded in used as name -> value (None when unset).
+    """
+    if isinstance(value, dict):
+        for key in value:
+            value[key] = interpolate(value[key], used)
+        return value
+    if isinstance(value, list):
+        return [interpolate(item, used) for item in value]
+    if not isinstance(value, string_types) or '$' not in value:
+        return value
+
+    def substitute(match):
+        escaped, name, operator, default, bare_name = match.groups()
+        if escaped:
+            return '$'
+        name = name or bare_name
+        used[name] = os.environ.get(name)
+        if operator == ':-' and not used[name] or operator == '-' and used[name] is None:
+            return default
+        if used[name] is None:
+            print('WARNING: variable {} is not set, substituting an empty string'.format(name), file=sys.stderr)
+        return used[name] or ''
+
+    return INTERPOLATION.sub(substitute, value)
+
+
+def echo(text, prefix=None):
+    """Writes text in one go, each line optionally prefixed, so that output of concurrent commands never interleaves mid-line."""
+    lines = text.split('\n')
+    if prefix is not None:
+        lines = ['{} | {}'.format(prefix, line) for line in lines]
+    with output_lock:
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+
 
 def shellquote(s):
-    return "'" + s.replace("'", "'\\''") + "'"
+    return "'" + str(s).replace("'", "'\\''") + "'"
 
 if __name__ == "__main__":
     main()
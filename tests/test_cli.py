@@ -0,0 +1,73 @@
+"""Tests of the docker CLI backend with the commands answered from memory."""
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import docker_compose_swarm_mode as dcsm
+
+
+class FakeCli(dcsm.DockerCli):
+    """Answers `docker service ls` and `docker service inspect` for services named after their IDs, with the tasks
+    given in tasks (name -> REPLICAS column)."""
+
+    max_command_length = 100
+
+    def __init__(self, services, tasks=None):
+        dcsm.DockerCli.__init__(self)
+        self.services = services
+        self.tasks = tasks or {}
+        self.commands = []
+
+    def call(self, cmd, ignore_return_code=False, prefix=None):
+        self.commands.append(cmd)
+        if cmd == 'docker service ls -q':
+            return '\n'.join(self.services)
+        if cmd == 'docker service ls':
+            return 'ID  NAME  MODE  REPLICAS  IMAGE\n' + ''.join(
+                '{0}  {0}  {1}  {2}  nginx:latest\n'.format(name, 'replicated' if 'Replicated' in service['Spec']['Mode'] else 'global',
+                                                            self.tasks.get(name, '1/1'))
+                for name, service in self.services.items())
+        if cmd.startswith('docker service inspect '):
+            return json.dumps([self.services[name] for name in cmd.split()[3:]])
+        return ''
+
+
+def service(name, replicas=1, mode=None, update=None):
+    return dict({'ID': name, 'Spec': {'Name': name, 'Mode': mode or {'Replicated': {'Replicas': replicas}}}},
+                **({'UpdateStatus': {'State': update}} if update else {}))
+
+
+class ListServicesTest(unittest.TestCase):
+    def test_services_are_inspected_in_batches(self):
+        names = ['service{:04d}'.format(index) for index in range(50)]
+        cli = FakeCli(dict((name, service(name)) for name in names))
+
+        self.assertEqual(sorted(cli.list_services()), names)
+        inspects = [cmd for cmd in cli.commands if cmd.startswith('docker service inspect ')]
+        self.assertGreater(len(inspects), 1)
+        self.assertTrue(all(len(cmd) <= cli.max_command_length for cmd in inspects))
+
+    def test_no_services(self):
+        cli = FakeCli({})
+        self.assertEqual(cli.list_services(), {})
+        self.assertEqual(cli.commands, ['docker service ls -q'])
+
+
+class ServiceStatusTest(unittest.TestCase):
+    def test_rolling_update_is_reported(self):
+        cli = FakeCli({'web': service('web', 2, update='updating'), 'api': service('api', 2, update='completed')},
+                      {'web': '2/2', 'api': '2/2'})
+        self.assertEqual(cli.service_status(['web', 'api']), {'web': (2, 2, True), 'api': (2, 2, False)})
+        self.assertEqual(len([cmd for cmd in cli.commands if cmd.startswith('docker service inspect ')]), 1)
+
+    def test_global_service_without_tasks_has_not_converged(self):
+        cli = FakeCli({'agent': service('agent', mode={'Global': {}}), 'other': service('other')}, {'agent': '0/0'})
+        self.assertEqual(cli.service_status(['agent']), {'agent': (0, 1, False)})
+
+
+if __name__ == '__main__':
+    unittest.main()
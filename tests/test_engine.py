@@ -0,0 +1,230 @@
+"""Tests of the Engine API client against a fake engine listening on a Unix socket."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import docker_compose_swarm_mode as dcsm
+
+
+class FakeEngine(ThreadingMixIn, UnixStreamServer):
+    """Answers requests with the handlers registered in routes, (method, path without the API version) -> handler."""
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        UnixStreamServer.__init__(self, path, Handler)
+        self.routes = {}
+        self.requests = []
+        self.connections = 0
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def address_string(self):
+        return 'fake'
+
+    def log_message(self, *args):
+        pass
+
+    def handle_request(self):
+        path = '/' + self.path.split('?')[0].split('/', 2)[2]
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+        self.server.requests.append((self.command, path, body))
+        route = self.server.routes.get((self.command, path))
+        if route is None:
+            self.reply(404, {'message': 'page not found'})
+        else:
+            route(self)
+
+    do_GET = do_POST = do_DELETE = handle_request
+
+    def reply(self, status, payload, content_type='application/json'):
+        data = (json.dumps(payload) if content_type == 'application/json' else payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def stream(self, lines):
+        """Sends lines as chunks, each one after the callable before it (if any) returned."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for line in lines:
+            if callable(line):
+                line()
+                continue
+            data = (line + '\n').encode('utf-8')
+            self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class EngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = FakeEngine(os.path.join(self.directory, 'docker.sock'))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.engine = dcsm.DockerEngine('unix://' + self.server.server_address, timeout=5)
+
+    def tearDown(self):
+        # lets the handlers of idle connections end before the server goes away
+        for connection in self.engine.idle_connections:
+            connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def route(self, method, path, status=200, payload=None, **options):
+        self.server.routes[(method, path)] = lambda handler: handler.reply(status, payload, **options)
+
+
+class PoolingTest(EngineTestCase):
+    def test_requests_reuse_one_connection(self):
+        self.route('GET', '/networks', payload=[{'Name': 'proj_front', 'Id': 'n1'}])
+        for _ in range(3):
+            self.assertEqual(self.engine.list_networks(), {'proj_front': 'n1'})
+        self.assertEqual(self.server.connections, 1)
+
+    def test_connection_closed_by_engine_is_replaced_before_sending(self):
+        def close_after_reply(handler):
+            handler.reply(200, {'Volumes': []})
+            handler.close_connection = True
+        self.server.routes[('GET', '/volumes')] = close_after_reply
+        self.route('POST', '/services/create', 201, {'ID': 'abc'})
+
+        self.engine.list_volumes()
+        time.sleep(0.1)
+        self.engine.create_service('proj_web', [], 'nginx', [])
+
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual([request[:2] for request in self.server.requests], [('GET', '/volumes'), ('POST', '/services/create')])
+
+    def test_request_that_timed_out_is_not_sent_again(self):
+        self.route('GET', '/networks', payload=[])
+
+        def slow(handler):
+            time.sleep(1)
+            handler.reply(201, {'ID': 'abc'})
+        self.server.routes[('POST', '/services/create')] = slow
+        self.engine = dcsm.DockerEngine('unix://' + self.server.server_address, timeout=0.3)
+
+        self.engine.list_networks()  # leaves an idle connection to reuse
+        self.assertRaises(dcsm.ComposeError, self.engine.create_service, 'proj_web', [], 'nginx', [])
+        time.sleep(1)
+        self.assertEqual(len([request for request in self.server.requests if request[0] == 'POST']), 1)
+
+
+class ErrorTest(EngineTestCase):
+    def test_engine_message_is_reported(self):
+        self.route('GET', '/services/proj_web', 500, {'message': 'rpc error: code = 4 desc = context deadline exceeded'})
+        try:
+            self.engine.inspect_service('proj_web')
+        except dcsm.EngineError as e:
+            self.assertEqual(e.status, 500)
+            self.assertIn('context deadline exceeded', str(e))
+        else:
+            self.fail('no EngineError raised')
+
+    def test_payload_is_reported_when_not_json(self):
+        self.route('DELETE', '/services/proj_web', 500, 'internal error', content_type='text/plain')
+        results = self.engine.remove_services(['proj_web'])
+        self.assertIsInstance(results['proj_web'], dcsm.EngineError)
+        self.assertIn('internal error', str(results['proj_web']))
+
+    def test_missing_service_is_none(self):
+        self.route('GET', '/services/proj_web', 404, {'message': 'service proj_web not found'})
+        self.assertIsNone(self.engine.find_service('proj_web'))
+
+    def test_unreachable_engine(self):
+        engine = dcsm.DockerEngine('unix://' + os.path.join(self.directory, 'missing.sock'))
+        self.assertRaises(dcsm.ComposeError, engine.list_services)
+
+
+class ServiceStatusTest(EngineTestCase):
+    def test_global_service_without_tasks_has_not_converged(self):
+        self.route('GET', '/services', payload=[
+            {'ID': 'a1', 'Spec': {'Name': 'p_agent', 'Mode': {'Global': {}}}},
+            {'ID': 'w1', 'Spec': {'Name': 'p_web', 'Mode': {'Replicated': {'Replicas': 1}}}, 'UpdateStatus': {'State': 'updating'}},
+        ])
+        self.route('GET', '/tasks', payload=[{'ServiceID': 'w1', 'Status': {'State': 'running'}}])
+        self.assertEqual(self.engine.service_status(['p_agent', 'p_web']), {'p_agent': (0, 1, False), 'p_web': (1, 1, True)})
+
+
+class EventsTest(EngineTestCase):
+    def test_events_are_handed_over_until_the_stream_ends(self):
+        self.server.routes[('GET', '/events')] = lambda handler: handler.stream([
+            json.dumps({'Type': 'service', 'Action': 'create', 'Actor': {'Attributes': {'name': 'p_web'}}}),
+            json.dumps({'Type': 'service', 'Action': 'remove', 'Actor': {'Attributes': {'name': 'p_web'}}}),
+        ])
+        events = []
+        self.engine.events(['service'], events.append, since=1500000000)
+        self.assertEqual([event['Action'] for event in events], ['create', 'remove'])
+
+    def test_missing_stream_is_reported(self):
+        self.assertRaises(dcsm.EngineError, self.engine.events, ['service'], lambda event: None)
+
+
+class PullTest(EngineTestCase):
+    def setUp(self):
+        EngineTestCase.setUp(self)
+        # the nodes are reached through the same fake engine
+        self.engine.node_engines['node1'] = self.engine
+
+    def test_progress_is_handed_over_as_it_arrives(self):
+        received = threading.Event()
+        handed_over = []
+        self.server.routes[('POST', '/images/create')] = lambda handler: handler.stream([
+            json.dumps({'status': 'Pulling from library/redis', 'id': 'latest'}),
+            lambda: handed_over.append(received.wait(5)),
+            json.dumps({'status': 'Status: Downloaded newer image for redis:latest'}),
+        ])
+
+        lines = []
+        self.engine.node_engine('node1').request('POST', '/images/create', query={'fromImage': 'redis', 'tag': 'latest'},
+                                                 on_line=lambda line: (lines.append(line), received.set()))
+
+        self.assertEqual(handed_over, [True])
+        self.assertEqual(len(lines), 2)
+
+    def test_error_in_stream_fails_the_pull(self):
+        self.server.routes[('POST', '/images/create')] = lambda handler: handler.stream([
+            json.dumps({'status': 'Pulling from library/redis', 'id': 'latest'}),
+            json.dumps({'errorDetail': {'message': 'manifest unknown'}, 'error': 'manifest unknown'}),
+        ])
+        try:
+            self.engine.pull_image('node1', 'redis:nope')
+        except dcsm.ComposeError as e:
+            self.assertEqual(str(e), 'manifest unknown')
+        else:
+            self.fail('no ComposeError raised')
+        self.assertEqual(self.server.requests[0][:2], ('POST', '/images/create'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+"""Tests of how the compose files are decoded and merged, and of the services extending each other."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import docker_compose_swarm_mode as dcsm
+
+
+class LoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        with open(os.path.join(self.directory, name), 'w') as compose_file:
+            compose_file.write(content)
+        return os.path.join(self.directory, name)
+
+    def load(self, *names):
+        return dcsm.ComposeLoader(self.directory + '/').load([os.path.join(self.directory, name) for name in names])
+
+
+class ExtendsTest(LoaderTestCase):
+    def test_bases_declared_after_the_services_extending_them(self):
+        self.write('docker-compose.yml', '''
+services:
+  web:
+    extends: {service: app}
+    image: nginx
+  app:
+    extends: {service: base}
+    environment: [LEVEL=info]
+  base:
+    image: base
+    environment: [LEVEL=debug, WORKERS=4]
+''')
+        services = self.load('docker-compose.yml')['services']
+        self.assertEqual(list(services), ['web', 'app', 'base'])
+        self.assertEqual(services['web'], {'image': 'nginx', 'environment': ['LEVEL=info', 'WORKERS=4']})
+        self.assertEqual(services['app'], {'image': 'base', 'environment': ['LEVEL=info', 'WORKERS=4']})
+
+    def test_services_of_another_file(self):
+        self.write('common.yml', '''
+services:
+  app:
+    extends: {service: base}
+    labels: [tier=back]
+  base:
+    image: base
+''')
+        self.write('docker-compose.yml', '''
+services:
+  web:
+    extends: {file: common.yml, service: app}
+  worker:
+    extends: {file: common.yml, service: app}
+    command: work
+''')
+        services = self.load('docker-compose.yml')['services']
+        self.assertEqual(services['web'], {'image': 'base', 'labels': ['tier=back']})
+        self.assertEqual(services['worker'], {'command': 'work', 'image': 'base', 'labels': ['tier=back']})
+
+    def test_cycle(self):
+        self.write('docker-compose.yml', '''
+services:
+  web: {extends: {service: app}}
+  app: {extends: {service: base}}
+  base: {extends: {service: app}}
+''')
+        with self.assertRaises(dcsm.ComposeError) as context:
+            self.load('docker-compose.yml')
+        self.assertEqual(str(context.exception), 'services extend each other in a cycle: app -> base -> app')
+
+    def test_cycle_across_files(self):
+        self.write('common.yml', '''
+services:
+  app: {extends: {file: docker-compose.yml, service: web}}
+''')
+        self.write('docker-compose.yml', '''
+services:
+  web: {extends: {file: common.yml, service: app}}
+''')
+        with self.assertRaises(dcsm.ComposeError) as context:
+            self.load('docker-compose.yml')
+        self.assertEqual(str(context.exception), 'services extend each other in a cycle: '
+                                                 'app in common.yml -> web in docker-compose.yml -> app in common.yml')
+
+    def test_missing_base(self):
+        self.write('docker-compose.yml', '''
+services:
+  web: {extends: {service: app}}
+''')
+        with self.assertRaises(dcsm.ComposeError) as context:
+            self.load('docker-compose.yml')
+        self.assertEqual(str(context.exception), 'cannot extend service "app": not found in the compose files')
+
+
+class MergeTest(LoaderTestCase):
+    def merge(self, *services):
+        return dcsm.merge_service_configs(list(services))
+
+    def test_environment_mapping_and_list(self):
+        self.assertEqual(self.merge({'environment': OrderedDict([('LEVEL', 'debug'), ('WORKERS', 4), ('TOKEN', None)])},
+                                    {'environment': ['LEVEL=info', 'REGION=eu']}),
+                         {'environment': ['LEVEL=info', 'WORKERS=4', 'TOKEN', 'REGION=eu']})
+        self.assertEqual(self.merge({'environment': OrderedDict([('LEVEL', 'debug'), ('WORKERS', 4)])},
+                                    {'environment': {'LEVEL': 'info'}}),
+                         {'environment': {'LEVEL': 'info', 'WORKERS': 4}})
+
+    def test_constraints_are_kept_apart(self):
+        self.assertEqual(self.merge({'environment': ['constraint:node.role==worker', 'LEVEL=debug']},
+                                    {'environment': ['constraint:node.labels.zone!=b', 'constraint:node.role==worker',
+                                                     'LEVEL=info']}),
+                         {'environment': ['constraint:node.role==worker', 'LEVEL=info', 'constraint:node.labels.zone!=b']})
+
+    def test_volumes_are_overridden_by_target(self):
+        self.assertEqual(self.merge({'volumes': ['data:/var/lib/data', '/etc/ssl/certs', 'logs:/var/log:ro']},
+                                    {'volumes': ['/srv/data:/var/lib/data', {'type': 'volume', 'source': 'audit',
+                                                                             'target': '/var/log'}]}),
+                         {'volumes': ['/srv/data:/var/lib/data', '/etc/ssl/certs',
+                                      {'type': 'volume', 'source': 'audit', 'target': '/var/log'}]})
+
+    def test_extended_service_loses_to_the_extending_one(self):
+        self.assertEqual(dcsm.merge_service_configs([{'image': 'web', 'labels': ['tier=front']},
+                                                     {'image': 'base', 'labels': ['tier=back', 'team=shop'],
+                                                      'ports': ['80:80']}], first_wins=True),
+                         {'image': 'web', 'labels': ['tier=front', 'team=shop'], 'ports': ['80:80']})
+
+    def test_files(self):
+        self.write('docker-compose.yml', '''
+version: '3'
+services:
+  web:
+    image: nginx
+    ports: ['80:80']
+    environment: [LEVEL=debug]
+networks:
+  front: {}
+''')
+        self.write('production.yml', '''
+services:
+  web:
+    image: nginx:1.13
+    ports: ['80:80', '443:443']
+    environment: {LEVEL: info}
+  worker:
+networks:
+  back: {}
+''')
+        compose = self.load('docker-compose.yml', 'production.yml')
+        self.assertEqual(compose['services'], {
+            'web': {'image': 'nginx:1.13', 'ports': ['80:80', '443:443'], 'environment': ['LEVEL=info']},
+            'worker': {},
+        })
+        self.assertEqual(list(compose['networks']), ['front', 'back'])
+
+
+class InterpolateTest(unittest.TestCase):
+    def setUp(self):
+        self.environ = dict(os.environ)
+        for name in ('TAG', 'EMPTY', 'UNSET'):
+            os.environ.pop(name, None)
+        os.environ.update(TAG='1.13', EMPTY='')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def test_substitution(self):
+        used = {}
+        self.assertEqual(dcsm.interpolate('nginx:$TAG ${TAG}-alpine $$TAG', used), 'nginx:1.13 1.13-alpine $TAG')
+        self.assertEqual(used, {'TAG': '1.13'})
+
+    def test_defaults(self):
+        used = {}
+        self.assertEqual(dcsm.interpolate('${UNSET-a} ${UNSET:-b} ${EMPTY-c} ${EMPTY:-d} ${TAG:-e}', used), 'a b  d 1.13')
+        self.assertEqual(used, {'UNSET': None, 'EMPTY': '', 'TAG': '1.13'})
+
+    def test_unset_variable_is_empty(self):
+        used = {}
+        self.assertEqual(dcsm.interpolate('x${UNSET}y', used), 'xy')
+        self.assertEqual(used, {'UNSET': None})
+
+    def test_nested_values(self):
+        used = {}
+        value = OrderedDict([('image', 'web:${TAG}'), ('replicas', 3), ('environment', ['TAG=$TAG', 'HOME=$$HOME'])])
+        self.assertEqual(dcsm.interpolate(value, used),
+                         {'image': 'web:1.13', 'replicas': 3, 'environment': ['TAG=1.13', 'HOME=$HOME']})
+
+
+if __name__ == '__main__':
+    unittest.main()
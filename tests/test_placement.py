@@ -0,0 +1,160 @@
+"""Tests of where the tasks of the services can run: placement constraints, the nodes images are pulled onto, the fit
+of the services on the nodes and the waves they are rolled out in."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import docker_compose_swarm_mode as dcsm
+
+GIB = 1024 ** 3
+
+
+def node(hostname, role='worker', labels=None, engine_labels=None, memory=None, cpus=2, availability='active'):
+    """Returns a node as `GET /nodes` reports it."""
+    resources = {'NanoCPUs': cpus * 10 ** 9}
+    if memory is not None:
+        resources['MemoryBytes'] = memory
+    return {'ID': 'id-' + hostname,
+            'Spec': {'Role': role, 'Availability': availability, 'Labels': labels or {}},
+            'Description': {'Hostname': hostname, 'Platform': {'OS': 'linux', 'Architecture': 'x86_64'},
+                            'Resources': resources, 'Engine': {'Labels': engine_labels or {}}}}
+
+
+def config(name, **service):
+    return dcsm.ServiceConfig.compile(name, service, '/tmp/')
+
+
+class NodeMatchesTest(unittest.TestCase):
+    def setUp(self):
+        self.node = node('gpu1', role='manager', labels={'gpu': 'true', 'zone': 'A'}, engine_labels={'storage': 'ssd'})
+
+    def test_attributes(self):
+        self.assertTrue(dcsm.node_matches(self.node, ['node.role==manager', 'node.hostname==gpu1', 'node.id==id-gpu1',
+                                                      'node.platform.os==linux', 'node.platform.arch!=arm64']))
+        self.assertFalse(dcsm.node_matches(self.node, ['node.role==manager', 'node.hostname!=gpu1']))
+
+    def test_labels(self):
+        self.assertTrue(dcsm.node_matches(self.node, ['node.labels.gpu==true', 'engine.labels.storage==ssd']))
+        self.assertTrue(dcsm.node_matches(self.node, ['node.labels.zone == a']))
+        self.assertFalse(dcsm.node_matches(self.node, ['node.labels.zone!=a']))
+        self.assertTrue(dcsm.node_matches(self.node, ['node.labels.rack!=r1']))
+        self.assertFalse(dcsm.node_matches(self.node, ['node.labels.rack==r1']))
+
+    def test_unknown_attributes_match(self):
+        self.assertTrue(dcsm.node_matches(self.node, ['node.ip==10.0.0.1', 'not a constraint']))
+        self.assertTrue(dcsm.node_matches(self.node, []))
+
+
+class PullTargetsTest(unittest.TestCase):
+    def test_images_go_to_the_nodes_their_services_can_run_on(self):
+        nodes = [node('manager1', role='manager'), node('gpu1', labels={'gpu': 'true'}), node('worker1'),
+                 node('worker2', availability='drain'), node('worker3', availability='pause')]
+        configs = [config('train', image='trainer', environment=['constraint:node.labels.gpu==true']),
+                   config('web', image='nginx', environment=['constraint:node.role==worker']),
+                   config('admin', image='nginx', environment=['constraint:node.role==manager']),
+                   config('agent', image='agent', mode='global')]
+        self.assertEqual(dcsm.pull_targets(configs, nodes), {
+            'trainer': ['gpu1'],
+            'nginx': ['manager1', 'gpu1', 'worker1', 'worker3'],
+            'agent': ['manager1', 'gpu1', 'worker1', 'worker3'],
+        })
+        self.assertEqual(list(dcsm.pull_targets(configs, nodes)), ['trainer', 'nginx', 'agent'])
+
+    def test_image_no_node_can_run(self):
+        configs = [config('train', image='trainer', environment=['constraint:node.labels.gpu==true'])]
+        self.assertEqual(dcsm.pull_targets(configs, [node('worker1')]), {'trainer': []})
+
+
+class FitTest(unittest.TestCase):
+    def fit(self, nodes, **services):
+        return dcsm.fit_services([(name, config(name, **service)) for name, service in sorted(services.items())], nodes)
+
+    def test_services_fitting(self):
+        nodes = [node('worker1', memory=GIB), node('worker2', memory=GIB)]
+        self.assertEqual(self.fit(nodes, web=dict(image='nginx', replicas=2, mem_limit='512m'),
+                                  api=dict(image='api', replicas=2, mem_limit='512m'), cron=dict(image='cron')), [])
+
+    def test_replicas_overcommitting_the_nodes(self):
+        nodes = [node('worker1', memory=GIB), node('worker2', memory=GIB), node('worker3', memory=4 * GIB, availability='drain')]
+        self.assertEqual(self.fit(nodes, web=dict(image='nginx', replicas=3, mem_limit='512m'),
+                                  db=dict(image='postgres', mem_limit='768m')),
+                         [('web', 3, 1, 512 * 1024 ** 2, ['worker1', 'worker2'])])
+
+    def test_global_service_on_a_small_node(self):
+        nodes = [node('worker1', memory=GIB), node('worker2', memory=GIB // 2)]
+        self.assertEqual(self.fit(nodes, agent=dict(image='agent', mode='global', mem_limit='768m')),
+                         [('agent', 2, 1, 768 * 1024 ** 2, ['worker1', 'worker2'])])
+
+    def test_constraints(self):
+        nodes = [node('gpu1', labels={'gpu': 'true'}, memory=GIB), node('worker1', memory=8 * GIB)]
+        self.assertEqual(self.fit(nodes, train=dict(image='trainer', replicas=2, mem_limit='1g',
+                                                    environment=['constraint:node.labels.gpu==true']),
+                                  mail=dict(image='mail', environment=['constraint:node.labels.zone==b'])),
+                         [('train', 2, 1, GIB, ['gpu1']), ('mail', 1, 1, 0, [])])
+
+    def test_nodes_not_reporting_memory_take_anything(self):
+        self.assertEqual(self.fit([node('worker1')], web=dict(image='nginx', replicas=100, mem_limit='1g')), [])
+
+    def test_check_fit(self):
+        nodes = [node('worker1', memory=GIB)]
+        overcommitted = [('web', config('web', image='nginx', replicas=3, mem_limit='512m'))]
+        dcsm.check_fit(overcommitted, nodes)
+        with self.assertRaises(dcsm.ComposeError) as context:
+            dcsm.check_fit(overcommitted, nodes, required=True)
+        self.assertEqual(str(context.exception), '1 of 1 services do not fit on the nodes')
+        with self.assertRaises(dcsm.ComposeError):
+            dcsm.check_fit([('train', config('train', image='trainer', environment=['constraint:node.labels.gpu==true']))],
+                           nodes)
+        dcsm.check_fit(overcommitted, [], required=True)
+
+
+def service_action(name, depends_on=()):
+    return {'name': 'service ' + name, 'action': 'create service', 'target': 'p_' + name, 'flags': [],
+            'depends_on': ['service ' + dependency for dependency in depends_on]}
+
+
+class RolloutWavesTest(unittest.TestCase):
+    def waves(self, actions, services, nodes):
+        plan = {'version': dcsm.PLAN_VERSION, 'networks': {}, 'actions': actions}
+        configs = dict(('p_' + name, config(name, **service)) for name, service in services.items())
+        return [[(action['target'], dict(action.get('flags', [])).get('--update-parallelism')) for action in wave['actions']]
+                for wave in dcsm.rollout_waves(plan, configs, nodes)]
+
+    def test_waves_as_big_as_the_cpus(self):
+        nodes = [node('worker1'), node('worker2'), node('worker3', availability='drain')]
+        network = {'name': 'network front', 'action': 'create network', 'target': 'p_front'}
+        actions = [network, service_action('web', ['db']), service_action('db'), service_action('worker')]
+        services = {'web': dict(image='nginx', replicas=3), 'db': dict(image='postgres'),
+                    'worker': dict(image='worker', replicas=2)}
+        self.assertEqual(self.waves(actions, services, nodes),
+                         [[('p_front', None), ('p_db', 1), ('p_web', 2)], [('p_worker', 2)]])
+
+    def test_waves_as_big_as_the_memory(self):
+        nodes = [node('worker1', memory=GIB, cpus=16), node('worker2', memory=GIB, cpus=16)]
+        actions = [service_action('web'), service_action('api'), service_action('cron')]
+        services = {'web': dict(image='nginx', replicas=2, mem_limit='512m', **{'x-rollout': {'update_parallelism': 1}}),
+                    'api': dict(image='api', replicas=2, mem_limit='512m'), 'cron': dict(image='cron', mem_limit='512m')}
+        self.assertEqual(self.waves(actions, services, nodes), [[('p_web', None), ('p_api', 2)], [('p_cron', 1)]])
+
+    def test_rollout_waves_come_first(self):
+        actions = [service_action('web'), service_action('db'), service_action('agent')]
+        services = {'web': dict(image='nginx', **{'x-rollout': {'wave': 2}}),
+                    'db': dict(image='postgres', **{'x-rollout': {'wave': 1}}), 'agent': dict(image='agent', mode='global')}
+        # without nodes, as with --dry-run, only the x-rollout waves are kept apart
+        self.assertEqual(self.waves(actions, services, []), [[('p_agent', 1)], [('p_db', 1)], [('p_web', 1)]])
+        self.assertEqual(self.waves(actions, services, [node('worker1', cpus=64), node('worker2', cpus=64)]),
+                         [[('p_agent', 2)], [('p_db', 1)], [('p_web', 1)]])
+
+    def test_dependency_on_a_later_wave(self):
+        actions = [service_action('web', ['db']), service_action('db')]
+        services = {'web': dict(image='nginx'), 'db': dict(image='postgres', **{'x-rollout': {'wave': 1}})}
+        with self.assertRaises(dcsm.ComposeError) as context:
+            self.waves(actions, services, [node('worker1')])
+        self.assertEqual(str(context.exception), 'service web (x-rollout wave 0) depends on service db of a later wave')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""Tests of what `up` plans to do given the compose files and the services already running."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import docker_compose_swarm_mode as dcsm
+
+
+def project(services, running=None):
+    """Returns the DockerCompose of the services, running as they are configured unless running (name -> mode, None for
+    a service that is not running) says otherwise."""
+    running = running or {}
+    compose = {'services': OrderedDict(services)}
+    state = dcsm.ClusterState()
+    compose_project = dcsm.DockerCompose(compose, 'p', '/tmp/', [], state=state)
+    for name in compose['services']:
+        if name in running and running[name] is None:
+            continue
+        flags, image, command, config_hash = compose_project.service_definition(name)
+        spec = dcsm.service_spec('p_' + name, flags, image, command)
+        if name in running:
+            spec['Mode'] = running[name]
+        state.services['p_' + name] = {'ID': name, 'Version': {'Index': 1}, 'Spec': spec}
+    return compose_project
+
+
+def actions(compose_project):
+    return [(action['action'], action['target']) + ((action['replicas'],) if 'replicas' in action else ())
+            for action in compose_project.up_plan()['actions']]
+
+
+class UpPlanTest(unittest.TestCase):
+    def test_unchanged_services_are_skipped(self):
+        compose_project = project([('agent', {'image': 'agent', 'mode': 'global'}), ('web', {'image': 'nginx', 'replicas': 3})])
+        self.assertEqual(actions(compose_project), [('skip', 'p_agent'), ('skip', 'p_web')])
+
+    def test_scaled_service_is_scaled_back(self):
+        compose_project = project([('web', {'image': 'nginx', 'replicas': 3})], {'web': {'Replicated': {'Replicas': 5}}})
+        self.assertEqual(actions(compose_project), [('scale service', 'p_web', 3)])
+
+    def test_missing_service_is_created(self):
+        compose_project = project([('agent', {'image': 'agent', 'mode': 'global'}), ('web', {'image': 'nginx'})], {'agent': None})
+        self.assertEqual(actions(compose_project), [('create service', 'p_agent'), ('skip', 'p_web')])
+
+    def test_zero_replicas_are_kept(self):
+        compose_project = project([('worker', {'image': 'worker', 'replicas': 0})])
+        self.assertEqual(actions(compose_project), [('skip', 'p_worker')])
+        self.assertEqual(compose_project.desired_replicas(['worker']), {'p_worker': 0})
+        deployment = [item for item in compose_project.kubernetes_objects('worker') if item['kind'] == 'Deployment'][0]
+        self.assertEqual(deployment['spec']['replicas'], 0)
+
+        compose_project = project([('worker', {'image': 'worker', 'replicas': 0})], {'worker': {'Replicated': {'Replicas': 1}}})
+        self.assertEqual(actions(compose_project), [('scale service', 'p_worker', 0)])
+
+
+class SavedPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.env_path = os.path.join(self.directory, 'app.env')
+        with open(self.env_path, 'w') as env_file:
+            env_file.write('LEVEL=info\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        dcsm.env_files.clear()
+
+    def test_plan_is_refused_once_an_env_file_changed(self):
+        compose_project = project([('web', {'image': 'nginx', 'env_file': self.env_path})], {'web': None})
+        plan = compose_project.up_plan()
+        self.assertEqual(list(plan['actions'][0]['env_files']), [self.env_path])
+        plan_path = os.path.join(self.directory, 'plan.json')
+        with open(plan_path, 'w') as plan_file:
+            json.dump(plan, plan_file)
+
+        with open(self.env_path, 'w') as env_file:
+            env_file.write('LEVEL=debug\n')
+        dcsm.env_files.clear()  # as in the run carrying out the plan
+        self.assertRaises(dcsm.ComposeError, dcsm.SavedPlan(plan_path, None).apply)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""Tests of `reconcile` against a fake backend replaying service events."""
+
+import os
+import sys
+import unittest
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import docker_compose_swarm_mode as dcsm
+
+
+class FakeBackend:
+    """Keeps the swarm objects in memory; events() hands over the events in the list given, then stops reconcile."""
+
+    def __init__(self):
+        self.services = {}
+        self.networks = {}
+        self.volumes = set()
+        self.calls = []
+        self.event_batches = []
+
+    def list_services(self):
+        return dict(self.services)
+
+    def list_networks(self):
+        return dict(self.networks)
+
+    def list_volumes(self):
+        return list(self.volumes)
+
+    def list_nodes(self):
+        return []
+
+    def find_service(self, name):
+        return self.services.get(name)
+
+    def create_network(self, name):
+        self.calls.append(('create network', name))
+        if name in self.networks:
+            raise dcsm.ComposeError('network {} already exists'.format(name))
+        self.networks[name] = 'id-' + name
+        return self.networks[name]
+
+    def create_volume(self, name, driver=None):
+        self.calls.append(('create volume', name))
+        if name in self.volumes:
+            raise dcsm.ComposeError('volume {} already exists'.format(name))
+        self.volumes.add(name)
+
+    def create_service(self, name, flags, image, command):
+        self.calls.append(('create service', name))
+        if name in self.services:
+            raise dcsm.ComposeError('service {} already exists'.format(name))
+        self.services[name] = {'ID': name, 'Version': {'Index': 1}, 'Spec': dcsm.service_spec(name, flags, image, command)}
+
+    def remove(self, name):
+        del self.services[name]
+        return {'Action': 'remove', 'Actor': {'Attributes': {'name': name}}}
+
+    def events(self, types, on_event, since=None):
+        for event in self.event_batches.pop(0) if self.event_batches else []:
+            on_event(event() if callable(event) else event)
+        raise KeyboardInterrupt
+
+
+def created(name):
+    return {'Action': 'create', 'Actor': {'Attributes': {'name': name}}}
+
+
+class ReconcileTest(unittest.TestCase):
+    def test_removed_service_is_created_again_without_its_network(self):
+        backend = FakeBackend()
+        compose = {'services': OrderedDict([('web', {'image': 'nginx', 'networks': ['front']})]),
+                   'networks': {'front': {}}, 'volumes': {'data': {}}}
+        # the stream starts with the events of what the first pass created, then the service is removed
+        backend.event_batches.append([created('p_web'), lambda: backend.remove('p_web')])
+
+        dcsm.DockerCompose(compose, 'p', '/tmp/', [], backend=backend).reconcile()
+
+        self.assertEqual(backend.calls, [('create network', 'p_front'), ('create volume', 'p_data'),
+                                         ('create service', 'p_web'), ('create service', 'p_web')])
+        self.assertIn('p_web', backend.services)
+
+
+if __name__ == '__main__':
+    unittest.main()
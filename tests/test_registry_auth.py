@@ -0,0 +1,73 @@
+"""Tests of the registry credentials sent along with the services, read as the docker CLI stores them."""
+
+import base64
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import docker_compose_swarm_mode as dcsm
+
+# answers `get` for registry.example.com and Docker Hub like docker-credential-pass does, fails for any other registry
+HELPER = '''#!/bin/sh
+read address
+case "$address" in
+  registry.example.com) echo '{"ServerURL":"registry.example.com","Username":"ci","Secret":"s3cret"}' ;;
+  https://index.docker.io/v1/) echo '{"ServerURL":"https://index.docker.io/v1/","Username":"<token>","Secret":"t0ken"}' ;;
+  *) echo "credentials not found in native keychain"; exit 1 ;;
+esac
+'''
+
+
+class RegistryAuthTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        helper_path = os.path.join(self.directory, 'docker-credential-fake')
+        with open(helper_path, 'w') as helper:
+            helper.write(HELPER)
+        os.chmod(helper_path, stat.S_IRWXU)
+        self.environ = dict(os.environ)
+        os.environ.update(DOCKER_CONFIG=self.directory, PATH=self.directory + os.pathsep + os.environ.get('PATH', ''))
+        dcsm.helper_credentials_cache.clear()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def config(self, config):
+        with open(os.path.join(self.directory, 'config.json'), 'w') as config_file:
+            json.dump(config, config_file)
+
+    def auth(self, image):
+        encoded = dcsm.registry_auth(image)
+        return encoded and json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+
+    def test_inline_credentials(self):
+        self.config({'auths': {'registry.example.com': {'auth': base64.b64encode(b'ci:s3cret').decode('ascii')}}})
+        self.assertEqual(self.auth('registry.example.com/shop/web:1.0'),
+                         {'username': 'ci', 'password': 's3cret', 'serveraddress': 'registry.example.com'})
+        self.assertIsNone(self.auth('nginx'))
+
+    def test_credentials_store(self):
+        self.config({'auths': {'registry.example.com': {}}, 'credsStore': 'fake'})
+        self.assertEqual(self.auth('registry.example.com/shop/web:1.0'),
+                         {'username': 'ci', 'password': 's3cret', 'serveraddress': 'registry.example.com'})
+        self.assertEqual(self.auth('shop/web'), {'identitytoken': 't0ken', 'serveraddress': 'https://index.docker.io/v1/'})
+        self.assertIsNone(self.auth('quay.io/shop/web'))
+
+    def test_credential_helper_of_the_registry(self):
+        self.config({'auths': {'other.example.com': {'auth': base64.b64encode(b'a:b').decode('ascii')}},
+                     'credHelpers': {'registry.example.com': 'fake', 'quay.io': 'missing'}})
+        self.assertEqual(self.auth('registry.example.com/shop/web')['username'], 'ci')
+        self.assertIsNone(self.auth('quay.io/shop/web'))
+        self.assertEqual(self.auth('other.example.com/web')['username'], 'a')
+
+
+if __name__ == '__main__':
+    unittest.main()
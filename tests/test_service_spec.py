@@ -0,0 +1,133 @@
+"""Tests of the `docker service update` flags computed from the spec `docker service inspect` reports."""
+
+import copy
+import os
+import sys
+import unittest
+from functools import partial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import docker_compose_swarm_mode as dcsm
+
+# `docker service inspect proj_web` (Docker 17.06) of the service created with FLAGS; the engine pins the image to its
+# digest, fills in defaults, and refers to networks by ID
+INSPECT = {
+    'ID': 'k9z2c6hkq3vgs0fd4c5d0hfdo',
+    'Version': {'Index': 1047},
+    'CreatedAt': '2017-08-02T09:12:31.712356381Z',
+    'UpdatedAt': '2017-08-02T09:12:31.716132553Z',
+    'Spec': {
+        'Name': 'proj_web',
+        'Labels': {'com.example.team': 'shop', 'docker-compose-swarm-mode.config-hash': '3f1c'},
+        'TaskTemplate': {
+            'ContainerSpec': {
+                'Image': 'nginx:1.13@sha256:9e5e1e6ebfe8d4e3cbc4b7f7e1a4d2ed9c3d1dc4a1df8a9c1ef5c0a8b1c6f0d2',
+                'Args': ['nginx', '-g', 'daemon off;'],
+                'Env': ['LEVEL=info', 'WORKERS=4'],
+                'Mounts': [
+                    {'Type': 'volume', 'Source': 'proj_static', 'Target': '/usr/share/nginx/html'},
+                    {'Type': 'bind', 'Source': '/etc/ssl/certs', 'Target': '/etc/ssl/certs', 'ReadOnly': True},
+                ],
+                'StopGracePeriod': 10000000000,
+                'DNSConfig': {},
+            },
+            'Resources': {'Limits': {'MemoryBytes': 536870912}, 'Reservations': {}},
+            'RestartPolicy': {'Condition': 'on-failure', 'Delay': 5000000000, 'MaxAttempts': 0},
+            'Placement': {'Constraints': ['node.role==worker']},
+            'Networks': [{'Target': 'x2k7h1v0q5rj8m3n6b9c4d1f0'}],
+            'LogDriver': {'Name': 'json-file', 'Options': {'max-size': '10m'}},
+            'ForceUpdate': 0,
+            'Runtime': 'container',
+        },
+        'Mode': {'Replicated': {'Replicas': 2}},
+        'UpdateConfig': {'Parallelism': 1, 'FailureAction': 'pause', 'Monitor': 5000000000, 'MaxFailureRatio': 0,
+                         'Order': 'stop-first'},
+        'RollbackConfig': {'Parallelism': 1, 'FailureAction': 'pause', 'Monitor': 5000000000, 'MaxFailureRatio': 0,
+                           'Order': 'stop-first'},
+        'EndpointSpec': {'Mode': 'vip', 'Ports': [{'Protocol': 'tcp', 'TargetPort': 80, 'PublishedPort': 8080,
+                                                   'PublishMode': 'ingress'}]},
+    },
+    'Endpoint': {
+        'Spec': {'Mode': 'vip', 'Ports': [{'Protocol': 'tcp', 'TargetPort': 80, 'PublishedPort': 8080, 'PublishMode': 'ingress'}]},
+        'Ports': [{'Protocol': 'tcp', 'TargetPort': 80, 'PublishedPort': 8080, 'PublishMode': 'ingress'}],
+        'VirtualIPs': [{'NetworkID': 'x2k7h1v0q5rj8m3n6b9c4d1f0', 'Addr': '10.0.0.5/24'}],
+    },
+}
+
+FLAGS = [
+    ('--restart-condition', 'on-failure'),
+    ('--log-driver', 'json-file'),
+    ('--log-opt', 'max-size=10m'),
+    ('--limit-memory', '512m'),
+    ('--label', 'com.example.team=shop'),
+    ('--publish', '8080:80'),
+    ('--network', 'proj_front'),
+    ('--mount', 'src=proj_static,dst=/usr/share/nginx/html,readonly=0'),
+    ('--mount', 'type=bind,src=/etc/ssl/certs,dst=/etc/ssl/certs,readonly=1'),
+    ('--env', 'LEVEL=info'),
+    ('--env', 'WORKERS=4'),
+    ('--constraint', 'node.role==worker'),
+    ('--replicas', 2),
+    ('--label', 'docker-compose-swarm-mode.config-hash=3f1c'),
+]
+
+NETWORKS = {'proj_front': 'x2k7h1v0q5rj8m3n6b9c4d1f0', 'ingress': 'q8w1e2r3t4y5u6i7o8p9a0s1d'}
+
+
+def update_flags(flags, image='nginx:1.13', command=('nginx', '-g', 'daemon off;'), current=None):
+    spec = dcsm.service_spec('proj_web', flags, image, list(command))
+    return dcsm.service_update_flags(spec, (current or INSPECT)['Spec'], partial(dcsm.network_name, NETWORKS))
+
+
+def replace(flags, old, new):
+    return [new if flag == old else flag for flag in flags]
+
+
+class ServiceUpdateFlagsTest(unittest.TestCase):
+    def test_unchanged_service_needs_no_flags(self):
+        self.assertEqual(update_flags(FLAGS), [])
+
+    def test_changed_settings(self):
+        flags = replace(FLAGS, ('--env', 'LEVEL=info'), ('--env', 'LEVEL=debug'))
+        flags = replace(flags, ('--replicas', 2), ('--replicas', 3))
+        flags = replace(flags, ('--limit-memory', '512m'), ('--limit-memory', '1g'))
+        flags.remove(('--label', 'com.example.team=shop'))
+        flags.append(('--publish', '8443:443'))
+
+        self.assertEqual(update_flags(flags), [
+            ('--env-add', 'LEVEL=debug'),
+            ('--publish-add', '8443:443/tcp'),
+            ('--label-rm', 'com.example.team'),
+            ('--replicas', 3),
+            ('--limit-memory', '1073741824b'),
+        ])
+
+    def test_image_and_command(self):
+        self.assertEqual(update_flags(FLAGS, image='nginx:1.13@sha256:9e5e1e6ebfe8d4e3cbc4b7f7e1a4d2ed9c3d1dc4a1df8a9c1ef5c0a8b1c6f0d2'), [])
+        self.assertEqual(update_flags(FLAGS, image='nginx:1.15', command=['nginx']),
+                         [('--image', 'nginx:1.15'), ('--args', "'nginx'")])
+
+    def test_removed_mount_network_and_constraint(self):
+        flags = [flag for flag in FLAGS if flag[0] not in ('--mount', '--network', '--constraint')]
+        self.assertEqual(update_flags(flags), [
+            ('--constraint-rm', 'node.role==worker'),
+            ('--mount-rm', '/usr/share/nginx/html'),
+            ('--mount-rm', '/etc/ssl/certs'),
+            ('--network-rm', 'proj_front'),
+        ])
+
+    def test_update_config(self):
+        self.assertEqual(update_flags(FLAGS + [('--update-parallelism', 2), ('--update-delay', '10s')]),
+                         [('--update-parallelism', 2), ('--update-delay', '10000000000ns')])
+
+        current = copy.deepcopy(INSPECT)
+        current['Spec']['UpdateConfig'].update(Parallelism=2, Delay=10000000000)
+        self.assertEqual(update_flags(FLAGS, current=current), [('--update-parallelism', 1), ('--update-delay', '0ns')])
+
+    def test_mode_cannot_change(self):
+        self.assertRaises(dcsm.ComposeError, update_flags, FLAGS + [('--mode', 'global')])
+
+
+if __name__ == '__main__':
+    unittest.main()